@@ -1,329 +1,1429 @@
 import os
+import logging
+import random
 import requests
-import xml.etree.ElementTree as ET
-from flask import Flask, Response, send_file, request
-from datetime import datetime, timedelta
+import requests.adapters
+from urllib.parse import urlsplit
+from flask import Flask, Response, request
+from datetime import datetime, timedelta, timezone
 import argparse
-import pytz
-from PIL import Image, ImageDraw, ImageFont
+import json
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 import io
-import base64
+import sys
+from dataclasses import dataclass
+from enum import Enum
+import bisect
+import functools
+import hashlib
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
 
-app = Flask(__name__)
+try:
+    import fcntl # Cross-process file locks; not available on Windows
+except ImportError:
+    fcntl = None
 
-# Cache for downloaded images to avoid repeated downloads
-image_cache = {}
+try:
+    import brotli # Optional: enables precompressed Brotli responses
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 
-def get_f1_schedule():
-    """Fetches the current F1 season schedule from the Jolpica API."""
-    current_year = datetime.now().year
-    
+logger = logging.getLogger("f1_epg")
+LOG_FORMAT = "%(asctime)s level=%(levelname)s logger=%(name)s thread=%(threadName)s %(message)s"
+
+# Prometheus metrics, exported on /metrics. Cache and schedule state is read at scrape time by StatsCollector.
+UPSTREAM_FETCH_SECONDS = Histogram("f1epg_upstream_fetch_seconds", "Latency of outbound HTTP requests",
+                                   ["upstream"])
+UPSTREAM_ERRORS = Counter("f1epg_upstream_errors_total", "Failed outbound HTTP requests",
+                          ["upstream", "reason"])
+DOCUMENT_BUILD_SECONDS = Histogram("f1epg_document_build_seconds",
+                                   "Time to generate a guide document (XMLTV, M3U, JSON, iCalendar)", ["format"],
+                                   buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1))
+DOCUMENT_SERIALIZE_SECONDS = Histogram("f1epg_document_serialize_seconds",
+                                       "Time to encode, hash and pre-compress a guide document", ["format"],
+                                       buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1))
+SCHEDULE_CHANGES = Counter("f1epg_schedule_changes_total", "Sessions changed by schedule refreshes",
+                           ["change"])
+BOUNDARY_REBUILDS = Counter("f1epg_boundary_rebuilds_total",
+                            "Cached documents whose time-dependent part was rebuilt at a session boundary")
+ICON_RENDER_SECONDS = Histogram("f1epg_icon_render_seconds", "Time to render a channel icon",
+                                buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1))
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by the total size of its bytes values.
+
+    get_or_create is single-flight: concurrent misses for one key wait on a single call to the
+    factory instead of each computing the value."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _put(self, key, value):
+        if len(value) > self.max_bytes:
+            return # Would evict everything else and still not fit
+        if key in self._entries:
+            self.size -= len(self._entries.pop(key))
+        self._entries[key] = value
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def get_or_create(self, key, factory, cacheable=None):
+        """Returns the cached value for key, calling factory() once to fill it on a miss. With
+        cacheable, a value is only kept if cacheable(value) is true."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if not owner:
+            return future.result()
+        try:
+            value = factory()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(value)
+            if cacheable is None or cacheable(value):
+                with self._lock:
+                    self._put(key, value)
+            return value
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.size, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+# Rendered channel icons, keyed by canonical country code (None for the plain icon). Each is a few KB.
+image_cache = LRUCache(max_bytes=1024 * 1024)
+
+# Used as Last-Modified for generated images, which only change when the process restarts
+STARTED_AT = datetime.now(timezone.utc).replace(microsecond=0)
+
+def atomic_write(path, data):
+    """Writes bytes to path via a temporary file and rename, so readers (including other
+    worker processes) never see a partially written file."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
     try:
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-        response = requests.get(f"https://api.jolpi.ca/ergast/f1/{current_year}.json", headers=headers)
-        response.raise_for_status()  # Raise an exception for bad status codes
-        data = response.json()
-        if data['MRData']['RaceTable']['Races']:
-            return data['MRData']['RaceTable']['Races']
-        return None
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching F1 schedule for {current_year}: {e}")
-        return None
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
 
-def generate_xmltv(races, target_timezone, base_url):
-    """Generates an XMLTV string from a list of F1 races, including all sessions and placeholders,
-    converted to the specified target_timezone, with F1 logo and country flags."""
-    tv = ET.Element("tv")
-    tv.set("generator-info-name", "F1 EPG Server")
-
-    if not races:
-        return ET.tostring(tv, encoding='unicode')
-
-    # Define session types and their default durations
-    session_types = {
-        "FirstPractice": {"name": "First Practice", "duration_hours": 1},
-        "SecondPractice": {"name": "Second Practice", "duration_hours": 1},
-        "ThirdPractice": {"name": "Third Practice", "duration_hours": 1},
-        "Qualifying": {"name": "Qualifying", "duration_hours": 1},
-        "SprintQualifying": {"name": "Sprint Qualifying", "duration_hours": 0.5}, # 30 minutes
-        "Sprint": {"name": "Sprint Race", "duration_hours": 1},
-        "Race": {"name": "Race", "duration_hours": 2},
-    }
+@contextmanager
+def file_lock(path, blocking=True):
+    """Holds an advisory cross-process lock on path, yielding whether it was acquired.
 
-    # Mapping from country name (from Ergast API) to ISO 3166-1 alpha-2 code for flagcdn.com
-    country_code_map = {
-        "Bahrain": "bh", "Australia": "au", "China": "cn", "Japan": "jp", "Saudi Arabia": "sa",
-        "United States": "us", "Mexico": "mx", "Brazil": "br", "Canada": "ca", "Austria": "at",
-        "Great Britain": "gb", "Hungary": "hu", "Belgium": "be", "Netherlands": "nl", "Italy": "it",
-        "Singapore": "sg", "Azerbaijan": "az", "Qatar": "qa", "Abu Dhabi": "ae", "Spain": "es",
-        "Monaco": "mc", "France": "fr", "Portugal": "pt", "Germany": "de", "Russia": "ru",
-        "Turkey": "tr", "Malaysia": "my", "India": "in", "Korea": "kr", "Vietnam": "vn",
-        "UAE": "ae", # Added United Arab Emirates
-        "Europe": "eu", # For generic European events if any
-        # Added more common F1 countries and reordered for clarity
-    }
+    Used to let one worker process do work (fetching, rendering) that the others then
+    read from disk. Without a path, on platforms without fcntl, or if the lock file can't be
+    created (e.g. a read-only directory), it is always acquired."""
+    if not path or fcntl is None:
+        yield True
+        return
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        f = open(path, "a")
+    except OSError as e:
+        logger.warning(f"Could not open lock file {path}, continuing without it: {e}")
+        yield True
+        return
+    with f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised without contacting a host while its circuit breaker is open. Callers handle it like
+    any other RequestException, i.e. by falling back to their cached copy."""
+
+class HTTPClient:
+    """The single client used for every outbound request (schedule, logo and flags).
+
+    It keeps a pooled keep-alive session, applies connect/read timeouts, retries connection
+    errors, timeouts, 429s and 5xx responses with jittered exponential backoff, and trips a
+    per-host circuit breaker after failure_threshold consecutive failed calls. While a breaker
+    is open, calls to that host fail immediately for reset_timeout seconds, after which one
+    trial call is let through."""
+
+    # Status codes worth retrying rather than returning to the caller straight away
+    RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+    def __init__(self, timeout=(3.05, 10), retries=2, backoff=0.5, max_backoff=8,
+                 failure_threshold=5, reset_timeout=60):
+        self.timeout = timeout # (connect, read) seconds
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._failures = {} # host -> consecutive failed calls
+        self._opened_at = {} # host -> time.time() the breaker tripped
+        self._lock = threading.Lock()
+
+    def _before_call(self, host):
+        with self._lock:
+            opened_at = self._opened_at.get(host)
+            if opened_at is None:
+                return
+            if time.time() - opened_at < self.reset_timeout:
+                UPSTREAM_ERRORS.labels(host, "circuit_open").inc()
+                raise CircuitOpenError(f"Circuit open for {host} after {self._failures[host]} failures")
+            # Half-open: let this call through as a trial, re-opening the breaker if it fails
+            self._opened_at[host] = time.time()
+
+    def _after_call(self, host, ok):
+        with self._lock:
+            if ok:
+                self._failures.pop(host, None)
+                self._opened_at.pop(host, None)
+                return
+            self._failures[host] = self._failures.get(host, 0) + 1
+            if self._failures[host] >= self.failure_threshold:
+                self._opened_at[host] = time.time()
+
+    def get(self, url, headers=None):
+        """GETs url, retrying transient failures. Returns the last response (which may be an error
+        status for the caller's raise_for_status) or raises the last RequestException."""
+        host = urlsplit(url).netloc
+        self._before_call(host)
+        for attempt in range(self.retries + 1):
+            if attempt:
+                # "Full jitter" backoff keeps many clients from retrying in lockstep
+                time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+            try:
+                with UPSTREAM_FETCH_SECONDS.labels(host).time():
+                    response = self.session.get(url, headers=headers, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                UPSTREAM_ERRORS.labels(host, "timeout" if isinstance(e, requests.exceptions.Timeout) else "connection").inc()
+                error = e
+                continue
+            if response.status_code not in self.RETRY_STATUSES:
+                if response.status_code >= 400:
+                    UPSTREAM_ERRORS.labels(host, "status").inc()
+                self._after_call(host, True)
+                return response
+            UPSTREAM_ERRORS.labels(host, "status").inc()
+            error = None
+        self._after_call(host, False)
+        if error is not None:
+            raise error
+        return response
+
+    async def get_async(self, url, headers=None):
+        """get() as a coroutine, run on a worker thread so several fetches can be gathered concurrently."""
+        import asyncio # Only needed to prefetch icon assets, so kept off the startup path
+        return await asyncio.to_thread(self.get, url, headers)
 
-    all_programmes = []
+http_client = HTTPClient()
 
+JOLPICA_URL = "https://api.jolpi.ca/ergast/f1/{year}.json"
+
+# Sentinel returned by schedule sources when the schedule is unchanged (e.g. 304 Not Modified)
+NOT_MODIFIED = object()
+
+class ScheduleSource(ABC):
+    """Where ScheduleStore gets each season's races from.
+
+    fetch(year, etag, last_modified) returns a (races, etag, last_modified) tuple, where races
+    is NOT_MODIFIED if the schedule is unchanged since the given validators, an empty list if
+    the season isn't published yet and None on error."""
+
+    name = "source"
+
+    @abstractmethod
+    def fetch(self, year, etag=None, last_modified=None):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.name})"
+
+class MirrorSource(ScheduleSource):
+    """Jolpica-format JSON served over HTTP, e.g. by an internal mirror of the Jolpica API.
+    url_template contains {year}. Uses conditional requests when validators are given."""
+
+    name = "mirror"
+
+    def __init__(self, url_template):
+        self.url_template = url_template
+
+    def fetch(self, year, etag=None, last_modified=None):
+        try:
+            headers = {}
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+            response = http_client.get((self.url_template or JOLPICA_URL).format(year=year), headers=headers)
+            if response.status_code == 304:
+                return NOT_MODIFIED, etag, last_modified
+            response.raise_for_status()  # Raise an exception for bad status codes
+            data = response.json()
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            return data['MRData']['RaceTable']['Races'], etag, last_modified
+        except (requests.exceptions.RequestException, KeyError, TypeError, ValueError) as e:
+            # A malformed body fails the fetch too, so the store keeps the last good copy
+            logger.error(f"Error fetching F1 schedule for {year} from {self.name}: {e}")
+            return None, etag, last_modified
+
+class JolpicaSource(MirrorSource):
+    """The public Jolpica API."""
+
+    name = "jolpica"
+
+    def __init__(self):
+        super().__init__(None) # JOLPICA_URL is looked up on every fetch, so it can be repointed
+
+class FileSource(ScheduleSource):
+    """Races from local JSON files, e.g. a recorded fixture or a calendar kept by hand.
+
+    path is either a directory of <year>.json files or a single file (see load_races_file)
+    holding any number of seasons. The file's modification time and size stand in for an
+    ETag, so an untouched file is NOT_MODIFIED."""
+
+    name = "file"
+
+    def __init__(self, path):
+        self.path = path
+
+    def fetch(self, year, etag=None, last_modified=None):
+        is_dir = os.path.isdir(self.path)
+        path = os.path.join(self.path, f"{year}.json") if is_dir else self.path
+        try:
+            if is_dir and not os.path.exists(path):
+                return [], None, None # Season not published (yet)
+            stat = os.stat(path)
+            validator = f'"{stat.st_mtime_ns}-{stat.st_size}"'
+            if validator == etag:
+                return NOT_MODIFIED, etag, last_modified
+            races = load_races_file(path)
+            if is_dir: # <year>.json: races without a season belong to that year
+                races = [race for race in races if str(race.get('season', year)) == str(year)]
+            else: # One file for every season: races without one go to the current year, as in group_by_season
+                races = group_by_season(races).get(str(year), [])
+            return races, validator, None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error(f"Error reading F1 schedule for {year} from {path}: {e}")
+            return None, etag, last_modified
+
+def make_source(spec):
+    """Builds the ScheduleSource for a --source value: "jolpica", the URL of a Jolpica mirror
+    (containing {year}, or a base URL that /{year}.json is appended to), or a local path,
+    optionally written as file:<path>."""
+    if not spec or spec == "jolpica":
+        return JolpicaSource()
+    if spec.startswith(("http://", "https://")):
+        return MirrorSource(spec if "{year}" in spec else spec.rstrip("/") + "/{year}.json")
+    return FileSource(spec.removeprefix("file:"))
+
+# Bump when the layout written by ScheduleStore.save_snapshot changes
+SNAPSHOT_FORMAT_VERSION = 2
+
+def load_races_file(path):
+    """Reads races from a JSON file holding either a raw Jolpica response or a plain list of races."""
+    with open(path) as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = data['MRData']['RaceTable']['Races']
+    return data
+
+def group_by_season(races):
+    """Splits a race list into {season: races}, e.g. for a prewarm file spanning several seasons."""
+    seasons = {}
     for race in races:
-        race_name = race['raceName']
-        circuit_name = race['Circuit']['circuitName']
-        locality = race['Circuit']['Location']['locality']
-        country = race['Circuit']['Location']['country']
-        print(race)
-        country_code = country_code_map.get(country, "gb") # Default to GB if not found
-
-        sessions_for_weekend = []
-
-        # Add the main Race session
-        race_date_str = race['date']
-        race_time_str = race.get('time', '00:00:00Z')
+        seasons.setdefault(str(race.get('season', datetime.now().year)), []).append(race)
+    return seasons
+
+def schedule_hash(seasons):
+    """Content hash of a {season: races} mapping, independent of key order and formatting."""
+    return hashlib.sha256(json.dumps(seasons, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()[:32]
+
+# One session's change between two schedules. change is "added", "removed", "rescheduled"
+# (start moved) or "updated" (race, circuit or location changed); session is a
+# (season, round, Jolpica session key) tuple, and old/new are its details or None.
+ScheduleChange = namedtuple("ScheduleChange", ["change", "session", "old", "new"])
+
+def _session_index(seasons):
+    """Maps every session in {season: races} to (start, race, circuit, locality, country)."""
+    index = {}
+    for season, races in seasons.items():
+        for race in races:
+            location = race['Circuit']['Location']
+            details = (race['raceName'], race['Circuit']['circuitName'], location['locality'], location['country'])
+            for kind in (SessionKind.RACE,) + OTHER_SESSION_KINDS:
+                entry = race if kind is SessionKind.RACE else race.get(kind.api_key)
+                if entry is not None:
+                    start = f"{entry.get('date')}T{entry.get('time', '00:00:00Z')}"
+                    index[(season, race.get('round', race['raceName']), kind.api_key)] = (start,) + details
+    return index
+
+def session_hash(seasons):
+    """Hash of only the sessions in {season: races} (see _session_index). Every worker process
+    holding the same sessions gets the same hash, whatever else the races contain."""
+    index = sorted((list(key) + list(details) for key, details in _session_index(seasons).items()), key=json.dumps)
+    return hashlib.sha256(json.dumps(index, separators=(",", ":")).encode("utf-8")).hexdigest()[:32]
+
+def diff_sessions(old_seasons, new_seasons):
+    """Returns the ScheduleChanges turning old_seasons into new_seasons, session by session.
+    Fields the guide doesn't use (URLs, coordinates, ...) are ignored."""
+    old, new = _session_index(old_seasons), _session_index(new_seasons)
+    changes = []
+    for key, details in new.items():
+        before = old.get(key)
+        if before is None:
+            changes.append(ScheduleChange("added", key, None, details))
+        elif before[0] != details[0]:
+            changes.append(ScheduleChange("rescheduled", key, before, details))
+        elif before != details:
+            changes.append(ScheduleChange("updated", key, before, details))
+    changes.extend(ScheduleChange("removed", key, details, None) for key, details in old.items() if key not in new)
+    return changes
+
+class ScheduleStore:
+    """Holds the last good F1 schedule and keeps it fresh from a background thread.
+
+    The current season and the next seasons_ahead seasons are fetched, so the guide keeps
+    going over New Year and through the off-season once the next calendar is published.
+    Requests only ever read the cached copy. When the copy is older than refresh_interval
+    it is still served while a refresh runs in the background (stale-while-revalidate),
+    and a season that fails to refresh keeps its previous races and is retried after
+    retry_interval."""
+
+    def __init__(self, source=None, refresh_interval=900, retry_interval=60, snapshot_path=None,
+                 seasons_ahead=1):
+        self.source = source or JolpicaSource()
+        self.snapshot_path = snapshot_path
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+        self.seasons_ahead = seasons_ahead
+        self.seasons = {} # season (str) -> races
+        self.validators = {} # season (str) -> [etag, last_modified] of its last fetch
+        self.races = None # All seasons' races, oldest season first
+        self.content_hash = None # schedule_hash(seasons)
+        self.schedule = None # Schedule parsed from races, rebuilt only when races change
+        self.version = 0 # Bumped every time the served schedule changes
+        self.fetched_at = None # time.time() of the last fully successful fetch (including 304s)
+        self.updated_at = None # time.time() of the fetch that last changed a session, kept in the snapshot
+        self.fresh_hits = 0 # get() calls answered with a copy younger than refresh_interval
+        self.stale_hits = 0 # get() calls answered with a stale (or no) copy while revalidating
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._listeners = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def subscribe(self, listener):
+        """Calls listener(schedule, changes) each time the served schedule changes, with the list
+        of ScheduleChanges that made it change."""
+        self._listeners.append(listener)
+
+    def is_stale(self):
+        return self.fetched_at is None or time.time() - self.fetched_at >= self.refresh_interval
+
+    def get(self):
+        """Returns the cached Schedule without blocking, kicking off a background refresh if stale."""
+        if self.is_stale():
+            self.stale_hits += 1
+            self.refresh_async()
+        else:
+            self.fresh_hits += 1
+        return self.schedule
+
+    def season_years(self):
+        current = datetime.now(timezone.utc).year
+        return [str(current + i) for i in range(self.seasons_ahead + 1)]
+
+    def refresh(self):
+        """Fetches every season once. Returns True if the store holds a current copy afterwards."""
+        with self._lock:
+            if self._refreshing:
+                return False
+            self._refreshing = True
         try:
-            start_time_utc = datetime.strptime(f"{race_date_str}T{race_time_str}", "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=pytz.utc)
-            end_time_utc = start_time_utc + timedelta(hours=session_types["Race"]["duration_hours"])
-            sessions_for_weekend.append({
-                "start": start_time_utc,
-                "end": end_time_utc,
-                "title": f"F1 {session_types['Race']['name']} - {race_name}",
-                "desc": f"Live coverage of the Formula 1 {session_types['Race']['name']} for the {race_name} from {circuit_name} in {locality}, {country}.",
-                "is_placeholder": False,
-                "country_code": country_code
-            })
-        except ValueError as e:
-            print(f"Error parsing date/time for main Race of '{race_name}': {e}")
-
-        # Add other sessions
-        for session_key, session_info in session_types.items():
-            if session_key == "Race": # Already processed
-                continue
-            if session_key in race:
-                session_date_str = race[session_key]['date']
-                session_time_str = race[session_key].get('time', '00:00:00Z')
+            # With several worker processes sharing one snapshot, only the lock holder fetches
+            with file_lock(f"{self.snapshot_path}.lock" if self.snapshot_path else None, blocking=False) as acquired:
+                if self._sync_from_snapshot() or not acquired:
+                    return self.schedule is not None and not self.is_stale()
+                seasons, validators, failed = {}, {}, False
+                years = self.season_years()
+                # The seasons are fetched concurrently, so a refresh takes as long as the slowest one
+                with ThreadPoolExecutor(max_workers=len(years), thread_name_prefix="season-fetch") as executor:
+                    results = list(executor.map(
+                        lambda year: self.source.fetch(int(year), *self.validators.get(year, (None, None))), years))
+                for year, (races, etag, last_modified) in zip(years, results):
+                    if races is None:
+                        failed = True
+                        continue
+                    seasons[year] = self.seasons.get(year, []) if races is NOT_MODIFIED else races
+                    validators[year] = [etag, last_modified]
+                    logger.debug(f"Season {year}: {'not modified' if races is NOT_MODIFIED else f'{len(races)} races'}")
+                if failed:
+                    # Keep serving the last good copy of every season that couldn't be fetched
+                    seasons = {**self.seasons, **seasons}
+                    validators = {**self.validators, **validators}
+                    if seasons == self.seasons:
+                        return False
+                self._set_seasons(seasons, validators, self.fetched_at if failed else time.time())
+                self.save_snapshot() # Also on 304s, so other workers see the new fetched_at
+                return not failed
+        finally:
+            with self._lock:
+                self._refreshing = False
 
+    def _set_seasons(self, seasons, validators, fetched_at, updated_at=None):
+        """Installs seasons. Races with the same content hash as the current ones only update the
+        validators. Otherwise they are diffed session by session, and only if a session changed is
+        the Schedule reparsed, the version bumped and every listener told what changed.
+        updated_at, when the seasons come from a snapshot, is when their sessions last changed."""
+        content_hash = schedule_hash(seasons)
+        changed = content_hash != self.content_hash
+        changes = diff_sessions(self.seasons, seasons) if changed else []
+        rebuild = bool(changes) or (changed and self.schedule is None)
+        races = [race for year in sorted(seasons) for race in seasons[year]] if changed else self.races
+        schedule = self.schedule
+        if rebuild:
+            schedule = Schedule.from_races(races, self.version + 1, session_hash(seasons),
+                                           int(updated_at or fetched_at or time.time()))
+        if rebuild:
+            counts = {}
+            for change in changes:
+                counts[change.change] = counts.get(change.change, 0) + 1
+                SCHEDULE_CHANGES.labels(change.change).inc()
+                if self.schedule is not None and change.change in ("rescheduled", "updated"):
+                    logger.info(f"Session {change.change}: {' '.join(change.session)} {change.old} -> {change.new}")
+            logger.info(f"Schedule updated to version {schedule.version}: {len(races)} races in seasons "
+                        f"{', '.join(sorted(seasons))} ({', '.join(f'{n} {c}' for c, n in counts.items()) or 'no sessions'})")
+        elif changed:
+            logger.info("Schedule content changed without affecting any session; keeping version "
+                        f"{self.version}")
+        with self._lock:
+            if changed:
+                self.seasons = seasons
+                self.races = races
+                self.content_hash = content_hash
+            if rebuild:
+                self.schedule = schedule
+                self.version = schedule.version
+                self.updated_at = schedule.updated_at
+            self.validators = validators
+            self.fetched_at = fetched_at
+        if rebuild:
+            for listener in self._listeners:
                 try:
-                    start_time_utc = datetime.strptime(f"{session_date_str}T{session_time_str}", "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=pytz.utc)
-                    end_time_utc = start_time_utc + timedelta(hours=session_info["duration_hours"])
-                    sessions_for_weekend.append({
-                        "start": start_time_utc,
-                        "end": end_time_utc,
-                        "title": f"F1 {session_info['name']} - {race_name}",
-                        "desc": f"Live coverage of the Formula 1 {session_info['name']} for the {race_name} from {circuit_name} in {locality}, {country}.",
-                        "is_placeholder": False,
-                        "country_code": country_code
-                    })
-                except ValueError as e:
-                    print(f"Error parsing date/time for {session_info['name']} of '{race_name}': {e}")
-
-        # Sort sessions for the weekend by start time
-        sessions_for_weekend.sort(key=lambda x: x["start"])
-
-        # Add placeholders between sessions
-        for i in range(len(sessions_for_weekend)):
-            current_session = sessions_for_weekend[i]
-            all_programmes.append(current_session)
-
-            if i < len(sessions_for_weekend) - 1:
-                next_session = sessions_for_weekend[i+1]
-                gap_start = current_session["end"]
-                gap_end = next_session["start"]
-
-                # Only add a placeholder if there's a significant gap (e.g., more than 5 minutes)
-                if gap_end > gap_start + timedelta(minutes=5):
-                    all_programmes.append({
-                        "start": gap_start,
-                        "end": gap_end,
-                        "title": f"Next: {next_session['title'].replace('F1 ', '')} at {next_session['start'].astimezone(target_timezone).strftime('%H:%M %Z')}",
-                        "desc": f"Waiting for the next Formula 1 session: {next_session['title'].replace('F1 ', '')}.",
-                        "is_placeholder": True,
-                        "country_code": None # Placeholders don't have a specific country flag
-                    })
-
-    # Sort all programmes (sessions and placeholders) by start time
-    all_programmes.sort(key=lambda x: x["start"])
-
-    # Determine if there are any future races
-    has_future_races = False
-    for race in races:
-        race_date_str = race['date']
-        race_time_str = race.get('time', '00:00:00Z')
+                    listener(schedule, changes)
+                except Exception:
+                    logger.exception(f"Schedule change listener {listener!r} failed")
+
+    def load(self, races, fetched_at=None, validators=None):
+        """Replaces the served schedule with races obtained outside of fetch (snapshot or prewarm file)."""
+        self._set_seasons(group_by_season(races), validators or {}, fetched_at)
+
+    def save_snapshot(self):
+        """Atomically writes the current schedule to snapshot_path."""
+        if not self.snapshot_path or not self.races:
+            return
+        snapshot = {
+            "format": SNAPSHOT_FORMAT_VERSION,
+            "fetched_at": self.fetched_at,
+            "updated_at": self.updated_at,
+            "validators": self.validators,
+            "seasons": self.seasons,
+        }
         try:
-            start_time_utc = datetime.strptime(f"{race_date_str}T{race_time_str}", "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=pytz.utc)
-            if start_time_utc > datetime.utcnow().replace(tzinfo=pytz.utc):
-                has_future_races = True
-                break
-        except ValueError as e:
-            print(f"Error parsing date/time for race '{race['raceName']}': {e}")
-    
-    if not has_future_races:
-        # Add a "No upcoming races" programme entry
-        programme = ET.SubElement(tv, "programme")
-        start_time = datetime.now(target_timezone).replace(hour=0, minute=0, second=0, microsecond=0)
-        end_time = start_time + timedelta(days=1)
-        programme.set("start", start_time.strftime("%Y%m%d%H%M%S %z"))
-        programme.set("stop", end_time.strftime("%Y%m%d%H%M%S %z"))
-        programme.set("channel", "f1.channel")
-        title = ET.SubElement(programme, "title")
-        title.text = "No upcoming races"
-        desc = ET.SubElement(programme, "desc")
-        desc.text = "The Formula 1 season is over. Check back later for the next season's schedule."
-
-        # Add a channel entry
-        channel = ET.SubElement(tv, "channel")
-        channel.set("id", "f1.channel")
-        display_name = ET.SubElement(channel, "display-name")
-        display_name.text = "F1 TV - No upcoming races"
-        # Always add F1 logo to the channel
-        f1_logo_icon = ET.SubElement(channel, "icon")
-        icon_url = f"{base_url}/channel_icon.png"
-        f1_logo_icon.set("src", icon_url)
-        return ET.tostring(tv, encoding='unicode')
-    
-    all_programmes = []
+            atomic_write(self.snapshot_path, json.dumps(snapshot, separators=(",", ":")).encode("utf-8"))
+        except OSError as e:
+            logger.error(f"Error writing schedule snapshot to {self.snapshot_path}: {e}")
 
-    for race in races:
-        race_name = race['raceName']
-        circuit_name = race['Circuit']['circuitName']
-        locality = race['Circuit']['Location']['locality']
-        country = race['Circuit']['Location']['country']
-        print(race)
-        country_code = country_code_map.get(country, "gb") # Default to GB if not found
-
-        sessions_for_weekend = []
-
-        # Add the main Race session
-        race_date_str = race['date']
-        race_time_str = race.get('time', '00:00:00Z')
+    def _read_snapshot(self):
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return None
         try:
-            start_time_utc = datetime.strptime(f"{race_date_str}T{race_time_str}", "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=pytz.utc)
-            end_time_utc = start_time_utc + timedelta(hours=session_types["Race"]["duration_hours"])
-            sessions_for_weekend.append({
-                "start": start_time_utc,
-                "end": end_time_utc,
-                "title": f"F1 {session_types['Race']['name']} - {race_name}",
-                "desc": f"Live coverage of the Formula 1 {session_types['Race']['name']} for the {race_name} from {circuit_name} in {locality}, {country}.",
-                "is_placeholder": False,
-                "country_code": country_code
-            })
-        except ValueError as e:
-            print(f"Error parsing date/time for main Race of '{race_name}': {e}")
-
-        # Add other sessions
-        for session_key, session_info in session_types.items():
-            if session_key == "Race": # Already processed
-                continue
-            if session_key in race:
-                session_date_str = race[session_key]['date']
-                session_time_str = race[session_key].get('time', '00:00:00Z')
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Error reading schedule snapshot {self.snapshot_path}: {e}")
+            return None
+        if snapshot.get("format") == 1 and snapshot.get("races"):
+            # Single-season snapshot written by older versions
+            seasons = group_by_season(snapshot["races"])
+            snapshot = {"fetched_at": snapshot.get("fetched_at"), "seasons": seasons,
+                        "validators": {year: [snapshot.get("etag"), snapshot.get("last_modified")] for year in seasons}}
+        elif snapshot.get("format") != SNAPSHOT_FORMAT_VERSION or not snapshot.get("seasons"):
+            logger.warning(f"Ignoring schedule snapshot {self.snapshot_path}: unsupported format")
+            return None
+        return snapshot
+
+    def load_snapshot(self):
+        """Loads the schedule saved by save_snapshot. Returns True if a usable snapshot was found."""
+        snapshot = self._read_snapshot()
+        if snapshot is None:
+            return False
+        self._set_seasons(snapshot["seasons"], snapshot.get("validators", {}), snapshot.get("fetched_at"),
+                          snapshot.get("updated_at"))
+        return True
+
+    def _sync_from_snapshot(self):
+        """Adopts a snapshot saved by another worker process if it was fetched more recently than
+        our copy and is not stale yet. Returns True if it was adopted."""
+        snapshot = self._read_snapshot()
+        fetched_at = snapshot and snapshot.get("fetched_at")
+        if not fetched_at or fetched_at <= (self.fetched_at or 0) or time.time() - fetched_at >= self.refresh_interval:
+            return False
+        # An unchanged schedule keeps its version (and every cache keyed on it)
+        self._set_seasons(snapshot["seasons"], snapshot.get("validators", {}), fetched_at, snapshot.get("updated_at"))
+        return True
+
+    def refresh_async(self):
+        with self._lock:
+            if self._refreshing:
+                return
+        threading.Thread(target=self.refresh, name="schedule-refresh", daemon=True).start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                ok = self.refresh() if self.is_stale() else True
+            except Exception: # Keep refreshing (and serving the last good copy) whatever went wrong
+                logger.exception("Schedule refresh failed")
+                ok = False
+            if ok:
+                # Wake up when the copy goes stale; a fresh snapshot loaded at startup isn't refetched
+                self._stop.wait(max(self.fetched_at + self.refresh_interval - time.time(), 1))
+            else:
+                self._stop.wait(self.retry_interval)
+
+    def start(self):
+        """Starts the periodic background refresher (idempotent)."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="schedule-refresher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+schedule_store = ScheduleStore()
+
+class SessionKind(Enum):
+    """Kinds of programme in the guide, with their Jolpica key, display name and default duration."""
+    FIRST_PRACTICE = ("FirstPractice", "First Practice", 60 * 60)
+    SECOND_PRACTICE = ("SecondPractice", "Second Practice", 60 * 60)
+    THIRD_PRACTICE = ("ThirdPractice", "Third Practice", 60 * 60)
+    QUALIFYING = ("Qualifying", "Qualifying", 60 * 60)
+    SPRINT_QUALIFYING = ("SprintQualifying", "Sprint Qualifying", 30 * 60)
+    SPRINT = ("Sprint", "Sprint Race", 60 * 60)
+    RACE = ("Race", "Race", 2 * 60 * 60)
+    PLACEHOLDER = (None, "Placeholder", 0) # Gap between two sessions of a weekend
+
+    def __init__(self, api_key, display_name, duration):
+        self.api_key = api_key
+        self.display_name = display_name
+        self.duration = duration
+
+# Sessions other than the Race, in the order they are read from a Jolpica race entry
+OTHER_SESSION_KINDS = (
+    SessionKind.FIRST_PRACTICE, SessionKind.SECOND_PRACTICE, SessionKind.THIRD_PRACTICE,
+    SessionKind.QUALIFYING, SessionKind.SPRINT_QUALIFYING, SessionKind.SPRINT,
+)
+
+# Mapping from country name (from Ergast API) to ISO 3166-1 alpha-2 code for flagcdn.com
+COUNTRY_CODE_MAP = {
+    "Bahrain": "bh", "Australia": "au", "China": "cn", "Japan": "jp", "Saudi Arabia": "sa",
+    "United States": "us", "Mexico": "mx", "Brazil": "br", "Canada": "ca", "Austria": "at",
+    "Great Britain": "gb", "Hungary": "hu", "Belgium": "be", "Netherlands": "nl", "Italy": "it",
+    "Singapore": "sg", "Azerbaijan": "az", "Qatar": "qa", "Abu Dhabi": "ae", "Spain": "es",
+    "Monaco": "mc", "France": "fr", "Portugal": "pt", "Germany": "de", "Russia": "ru",
+    "Turkey": "tr", "Malaysia": "my", "India": "in", "Korea": "kr", "Vietnam": "vn",
+    "UAE": "ae", # Added United Arab Emirates
+    "Europe": "eu", # For generic European events if any
+}
+
+# Only add a placeholder if there's a significant gap between sessions (more than 5 minutes)
+MIN_PLACEHOLDER_GAP = 5 * 60
+
+@dataclass(slots=True)
+class Session:
+    """One programme in the guide. Times are UTC epoch seconds."""
+    start: int
+    end: int
+    kind: SessionKind
+    race_name: str
+    circuit_name: str
+    locality: str
+    country: str
+    country_code: str | None # None for placeholders
+    next_session: "Session | None" = None # Set on placeholders only
+    # The race's Jolpica season and round, which with kind identify the session across refreshes
+    season: str | None = None
+    round: str | None = None
 
+    @property
+    def is_placeholder(self):
+        return self.kind is SessionKind.PLACEHOLDER
+
+    @property
+    def name(self):
+        """Title without the "F1 " prefix, e.g. "Qualifying - Monaco Grand Prix"."""
+        return f"{self.kind.display_name} - {self.race_name}"
+
+    def title(self, target_timezone):
+        if self.is_placeholder:
+            next_start = datetime.fromtimestamp(self.next_session.start, target_timezone)
+            return f"Next: {self.next_session.name} at {next_start.strftime('%H:%M %Z')}"
+        return f"F1 {self.name}"
+
+    @property
+    def desc(self):
+        if self.is_placeholder:
+            return f"Waiting for the next Formula 1 session: {self.next_session.name}."
+        return (f"Live coverage of the Formula 1 {self.kind.display_name} for the {self.race_name} "
+                f"from {self.circuit_name} in {self.locality}, {self.country}.")
+
+def _parse_start(entry):
+    """Parses the date/time of a Jolpica race or session entry into a UTC epoch."""
+    start = datetime.strptime(f"{entry['date']}T{entry.get('time', '00:00:00Z')}", "%Y-%m-%dT%H:%M:%SZ")
+    return int(start.replace(tzinfo=timezone.utc).timestamp())
+
+class Schedule:
+    """The parsed, time-sorted session list derived once from a Jolpica race list."""
+
+    def __init__(self, programmes, version=0, content_hash=None, updated_at=0):
+        self.version = version # Local to this process; see content_hash for one shared by all workers
+        self.content_hash = content_hash # session_hash() of the races, if parsed by ScheduleStore
+        self.updated_at = updated_at # When a session last changed
+        self.programmes = programmes # Sessions and placeholders, sorted by start
+        self.sessions = [p for p in programmes if not p.is_placeholder]
+        self.session_starts = [p.start for p in self.sessions]
+        self.race_starts = sorted(p.start for p in self.sessions if p.kind is SessionKind.RACE)
+        # Interval index: programmes overlapping a window all start within max_duration before it
+        self.starts = [p.start for p in programmes]
+        self.max_duration = max((p.end - p.start for p in programmes), default=0)
+        self._local_times = {} # str(timezone) -> {epoch: XMLTV time}, see local_times()
+
+    @classmethod
+    def from_races(cls, races, version=0, content_hash=None, updated_at=0):
+        programmes = []
+        for race in races or []:
+            race_name = race['raceName']
+            season = str(race.get('season', datetime.now().year)) # As in group_by_season
+            race_round = str(race.get('round', race_name)) # As in _session_index
+            circuit_name = race['Circuit']['circuitName']
+            locality = race['Circuit']['Location']['locality']
+            country = race['Circuit']['Location']['country']
+            country_code = sys.intern(COUNTRY_CODE_MAP.get(country, "gb")) # Default to GB if not found
+
+            weekend = []
+            for kind, entry in [(SessionKind.RACE, race)] + [(k, race[k.api_key]) for k in OTHER_SESSION_KINDS if k.api_key in race]:
                 try:
-                    start_time_utc = datetime.strptime(f"{session_date_str}T{session_time_str}", "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=pytz.utc)
-                    end_time_utc = start_time_utc + timedelta(hours=session_info["duration_hours"])
-                    sessions_for_weekend.append({
-                        "start": start_time_utc,
-                        "end": end_time_utc,
-                        "title": f"F1 {session_info['name']} - {race_name}",
-                        "desc": f"Live coverage of the Formula 1 {session_info['name']} for the {race_name} from {circuit_name} in {locality}, {country}.",
-                        "is_placeholder": False,
-                        "country_code": country_code
-                    })
+                    start = _parse_start(entry)
                 except ValueError as e:
-                    print(f"Error parsing date/time for {session_info['name']} of '{race_name}': {e}")
-
-        # Sort sessions for the weekend by start time
-        sessions_for_weekend.sort(key=lambda x: x["start"])
-
-        # Add placeholders between sessions
-        for i in range(len(sessions_for_weekend)):
-            current_session = sessions_for_weekend[i]
-            all_programmes.append(current_session)
-
-            if i < len(sessions_for_weekend) - 1:
-                next_session = sessions_for_weekend[i+1]
-                gap_start = current_session["end"]
-                gap_end = next_session["start"]
-
-                # Only add a placeholder if there's a significant gap (e.g., more than 5 minutes)
-                if gap_end > gap_start + timedelta(minutes=5):
-                    all_programmes.append({
-                        "start": gap_start,
-                        "end": gap_end,
-                        "title": f"Next: {next_session['title'].replace('F1 ', '')} at {next_session['start'].astimezone(target_timezone).strftime('%H:%M %Z')}",
-                        "desc": f"Waiting for the next Formula 1 session: {next_session['title'].replace('F1 ', '')}.",
-                        "is_placeholder": True,
-                        "country_code": None # Placeholders don't have a specific country flag
-                    })
-
-    # Sort all programmes (sessions and placeholders) by start time
-    all_programmes.sort(key=lambda x: x["start"])
+                    logger.warning(f"Error parsing date/time for {kind.display_name} of '{race_name}': {e}")
+                    continue
+                weekend.append(Session(start, start + kind.duration, kind, race_name, circuit_name,
+                                       locality, country, country_code, season=season, round=race_round))
+            weekend.sort(key=lambda s: s.start)
 
-    # Generate XMLTV elements from the sorted programmes
-    for p in all_programmes:
-        programme = ET.SubElement(tv, "programme")
-        # Convert to target timezone before formatting
-        start_local = p["start"].astimezone(target_timezone)
-        stop_local = p["end"].astimezone(target_timezone)
+            for current, following in zip(weekend, weekend[1:] + [None]):
+                programmes.append(current)
+                if following is not None and following.start > current.end + MIN_PLACEHOLDER_GAP:
+                    programmes.append(Session(current.end, following.start, SessionKind.PLACEHOLDER, race_name,
+                                              circuit_name, locality, country, None, following))
+        programmes.sort(key=lambda p: p.start)
+        return cls(programmes, version, content_hash, updated_at)
+
+    def local_times(self, target_timezone):
+        """Returns every programme boundary formatted as an XMLTV time in target_timezone.
+
+        The conversions are done once per timezone and schedule, so a guide for a timezone seen
+        before only does dictionary lookups. At most MAX_TIMEZONES timezones are kept."""
+        key = str(target_timezone)
+        times = self._local_times.get(key)
+        if times is None:
+            boundaries = {p.start for p in self.programmes} | {p.end for p in self.programmes}
+            times = {epoch: _xmltv_time(epoch, target_timezone) for epoch in boundaries}
+            if len(self._local_times) >= MAX_TIMEZONES:
+                self._local_times.pop(next(iter(self._local_times)), None) # Oldest first
+            self._local_times[key] = times
+        return times
+
+    def sessions_started(self, now):
+        """Returns how many sessions have started by the epoch now. Everything in the guide that
+        depends on "now" only changes when this does."""
+        return bisect.bisect_right(self.session_starts, now)
+
+    def next_boundary(self, now):
+        """Returns the start of the first session after the epoch now, or None."""
+        started = self.sessions_started(now)
+        return self.session_starts[started] if started < len(self.session_starts) else None
+
+    def next_session(self, now, channel=None):
+        """Returns the first non-placeholder session starting after the epoch now (and routed to
+        channel, if given), or None."""
+        for index in range(self.sessions_started(now), len(self.sessions)):
+            if channel is None or channel.matches(self.sessions[index]):
+                return self.sessions[index]
+        return None
 
-        programme.set("start", start_local.strftime("%Y%m%d%H%M%S %z"))
-        programme.set("stop", stop_local.strftime("%Y%m%d%H%M%S %z"))
-        programme.set("channel", "f1.channel")
+    def has_future_races(self, now):
+        return bool(self.race_starts) and self.race_starts[-1] > now
 
-        title = ET.SubElement(programme, "title")
-        title.text = p["title"]
+    def programmes_between(self, start=None, end=None):
+        """Returns the programmes overlapping the [start, end) epoch window (None leaves a side open)
+        using a range lookup on the start index rather than a scan of every programme."""
+        lo = 0 if start is None else bisect.bisect_left(self.starts, start - self.max_duration)
+        hi = len(self.starts) if end is None else bisect.bisect_left(self.starts, end)
+        return [p for p in self.programmes[lo:hi] if start is None or p.end > start]
 
-        desc = ET.SubElement(programme, "desc")
-        desc.text = p["desc"]
+# Timezones whose converted times and rendered documents are kept at once (per process)
+MAX_TIMEZONES = 16
 
+@functools.lru_cache(maxsize=64)
+def lookup_timezone(name):
+    """Returns the tzinfo for an IANA timezone name. Raises ValueError for unknown names."""
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError): # ValueError: not even a valid key, e.g. "../x"
+        raise ValueError("Unknown timezone") from None
+
+def _xmltv_time(epoch, target_timezone):
+    return datetime.fromtimestamp(epoch, target_timezone).strftime("%Y%m%d%H%M%S %z")
+
+def _escape_text(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def _escape_attr(value):
+    return (_escape_text(value).replace('"', "&quot;")
+            .replace("\r", "&#13;").replace("\n", "&#10;").replace("\t", "&#09;"))
+
+def _element(tag, attrs, *children):
+    """Serializes one element the way ElementTree.tostring would. children are pre-serialized strings."""
+    attr_str = "".join(f' {name}="{_escape_attr(value)}"' for name, value in attrs)
+    if not children:
+        return f"<{tag}{attr_str} />"
+    return f"<{tag}{attr_str}>{''.join(children)}</{tag}>"
+
+def _text_element(tag, text):
+    return f"<{tag}>{_escape_text(text)}</{tag}>"
+
+@dataclass(frozen=True, slots=True)
+class Channel:
+    """An XMLTV channel and the rule routing programmes to it: sessions of one of kinds, optionally
+    only at races in countries (country codes), plus the placeholders between them if placeholders."""
+    id: str
+    name: str
+    kinds: frozenset
+    countries: frozenset | None = None
+    placeholders: bool = False
+    icon: str | None = None # Fixed icon URL instead of the next event's /channel_icon.png
+    stream: str | None = None # Stream URL listed for the channel in /playlist.m3u
+
+    def matches(self, p):
+        if p.is_placeholder:
+            if not self.placeholders:
+                return False
+            p = p.next_session # Route placeholders with the session they lead up to
+        return p.kind in self.kinds and (self.countries is None or p.country_code in self.countries)
+
+# The single channel carrying everything, used unless channels are configured
+DEFAULT_CHANNELS = (
+    Channel("f1.channel", "F1 TV", frozenset(OTHER_SESSION_KINDS + (SessionKind.RACE,)), placeholders=True,
+            stream=os.environ.get("F1_EPG_STREAM_URL")),
+)
+
+def load_channels(path):
+    """Reads channel definitions from a JSON list such as
+    [{"id": "f1.race", "name": "F1 Race", "kinds": ["Race", "Sprint"], "countries": ["gb"],
+      "placeholders": false, "icon": "https://...", "stream": "http://..."}], where kinds are
+    Jolpica session keys."""
+    with open(path) as f:
+        definitions = json.load(f)
+    kinds_by_key = {kind.api_key: kind for kind in SessionKind if kind is not SessionKind.PLACEHOLDER}
+    channels = []
+    for definition in definitions:
+        unknown = set(definition.get("kinds", [])) - set(kinds_by_key)
+        if unknown:
+            raise ValueError(f"Unknown session kinds for channel {definition.get('id')}: {', '.join(sorted(unknown))}")
+        countries = definition.get("countries")
+        channels.append(Channel(
+            id=definition["id"],
+            name=definition.get("name", definition["id"]),
+            kinds=frozenset(kinds_by_key[key] for key in definition.get("kinds", kinds_by_key)),
+            countries=frozenset(code.lower() for code in countries) if countries else None,
+            placeholders=definition.get("placeholders", False),
+            icon=definition.get("icon"),
+            stream=definition.get("stream"),
+        ))
+    if not channels:
+        raise ValueError("No channels defined")
+    return tuple(channels)
+
+TV_OPEN = '<tv generator-info-name="F1 EPG Server"'
+
+def iter_xmltv_head(schedule, target_timezone, window=None, channels=DEFAULT_CHANNELS, now=None):
+    """Yields the part of the XMLTV document that doesn't depend on "now": the opening <tv> tag
+    and one <programme> per session and placeholder in window, converted to target_timezone.
+    It only changes with the schedule itself, except that it is empty once there are no
+    future races (see iter_xmltv_tail)."""
+    if not schedule or not schedule.programmes:
+        yield TV_OPEN + " />"
+        return
+
+    yield TV_OPEN + ">"
+    if not schedule.has_future_races(int(time.time()) if now is None else now):
+        return
+
+    # Generate XMLTV elements from the sorted programmes
+    local_times = schedule.local_times(target_timezone)
+    for p in schedule.programmes if window is None else schedule.programmes_between(*window):
+        targets = [channel for channel in channels if channel.matches(p)]
+        if not targets:
+            continue
+        children = _text_element("title", p.title(target_timezone)) + _text_element("desc", p.desc)
         # Add country flag icon for actual sessions
-        if not p.get("is_placeholder", False) and p.get("country_code"):
-            icon = ET.SubElement(programme, "icon")
-            icon.set("src", f"https://flagcdn.com/16x12/{p['country_code'].lower()}.png")
-
-
-    # Determine the next event for the channel display name and icon
-    next_event_name = "Formula 1" # Default if no events found
-    next_event_country_code = "gb" # Initialize with a default country code
-    current_utc_time = datetime.utcnow().replace(tzinfo=pytz.utc)
-
-    if all_programmes:
-        # Find the first actual session (not a placeholder) that starts after the current time
-        found_next_event = False
-        for p in all_programmes:
-            if not p.get("is_placeholder", False) and p["start"] > current_utc_time:
-                next_event_name = p["title"].replace("F1 ", "") # Remove "F1 " prefix
-                next_event_country_code = p.get("country_code", "gb") # Get country code from the actual session
-                print(f"DEBUG: Next event country code from programme: {p.get('country_code')}, mapped code: {next_event_country_code}") # Debug print
-                found_next_event = True
-                break
-        
-        # If no future events are found, set a "No upcoming races" message
-        if not found_next_event:
-            next_event_name = "No upcoming races"
-            next_event_country_code = "gb" # Default to a generic country code
-
-    # Add a channel entry
-    channel = ET.SubElement(tv, "channel")
-    channel.set("id", "f1.channel")
-    display_name = ET.SubElement(channel, "display-name")
-    display_name.text = f"F1 TV - {next_event_name}"
-    # Always add F1 logo to the channel
-    f1_logo_icon = ET.SubElement(channel, "icon")
+        if not p.is_placeholder and p.country_code:
+            children += _element("icon", [("src", f"https://flagcdn.com/16x12/{p.country_code}.png")])
+        start, stop = local_times[p.start], local_times[p.end]
+        for channel in targets:
+            yield _element("programme", [("start", start), ("stop", stop), ("channel", channel.id)], children)
+
+def iter_xmltv_tail(schedule, target_timezone, base_url, channels=DEFAULT_CHANNELS, now=None):
+    """Yields the rest of the XMLTV document after iter_xmltv_head: the <channel> entries named
+    after each channel's next event, or the "No upcoming races" programme once the season is
+    over. This is the only part that changes at session boundaries."""
+    if not schedule or not schedule.programmes:
+        return
+
+    now = int(time.time()) if now is None else now
     icon_url = f"{base_url}/channel_icon.png"
-    if next_event_name != "No upcoming races":
-        icon_url += f"?country_code={next_event_country_code.lower()}"
-    f1_logo_icon.set("src", icon_url)
 
-    return ET.tostring(tv, encoding='unicode')
+    if not schedule.has_future_races(now):
+        # Add a "No upcoming races" programme entry
+        start_time = datetime.now(target_timezone).replace(hour=0, minute=0, second=0, microsecond=0)
+        end_time = start_time + timedelta(days=1)
+        for channel in channels:
+            yield _element("programme", [("start", start_time.strftime("%Y%m%d%H%M%S %z")),
+                                         ("stop", end_time.strftime("%Y%m%d%H%M%S %z")),
+                                         ("channel", channel.id)],
+                           _text_element("title", "No upcoming races"),
+                           _text_element("desc", "The Formula 1 season is over. Check back later for the next season's schedule."))
+        # Add the channel entries, always with the F1 logo
+        for channel in channels:
+            yield _element("channel", [("id", channel.id)],
+                           _text_element("display-name", f"{channel.name} - No upcoming races"),
+                           _element("icon", [("src", channel.icon or icon_url)]))
+        yield "</tv>"
+        return
+
+    for channel in channels:
+        # Determine the next event for the channel display name and icon
+        next_event = schedule.next_session(now, channel)
+        channel_icon_url = channel.icon or (f"{icon_url}?country_code={next_event.country_code}" if next_event else icon_url)
+        yield _element("channel", [("id", channel.id)],
+                       _text_element("display-name", f"{channel.name} - {next_event.name if next_event else 'No upcoming races'}"),
+                       _element("icon", [("src", channel_icon_url)]))
+    yield "</tv>"
 
-@app.route('/epg.xml')
-def epg():
-    """The main EPG endpoint."""
-    races = get_f1_schedule()
+def iter_xmltv(schedule, target_timezone, base_url, window=None, channels=DEFAULT_CHANNELS):
+    """Yields an XMLTV document for a parsed Schedule piece by piece, one <programme> at a time,
+    including all sessions and placeholders, converted to the specified target_timezone,
+    with F1 logo and country flags. window optionally limits the programmes to a
+    (start, end) epoch range. Every programme is routed to each of channels it matches in
+    the same pass, so extra channels only add the per-channel element."""
+    now = int(time.time())
+    yield from iter_xmltv_head(schedule, target_timezone, window, channels, now)
+    yield from iter_xmltv_tail(schedule, target_timezone, base_url, channels, now)
+
+def generate_xmltv(schedule, target_timezone, base_url, window=None, channels=DEFAULT_CHANNELS):
+    """Returns the complete XMLTV document produced by iter_xmltv as a string."""
+    return "".join(iter_xmltv(schedule, target_timezone, base_url, window, channels))
+
+RenderedDocument = namedtuple("RenderedDocument", ["body", "gzip", "br", "etag", "last_modified"])
+
+class DocumentHead:
+    """The encoded, hashed and gzip-compressed start of a document, kept so documents sharing it
+    only need their tail encoded, hashed and compressed (zlib and hashlib states can be copied)."""
+
+    def __init__(self, text):
+        self.body = text.encode("utf-8")
+        self._compressor = zlib.compressobj(9, zlib.DEFLATED, 31) # wbits 31: gzip container
+        self.gzip = self._compressor.compress(self.body)
+        self._hash = hashlib.sha256(self.body)
+
+    def finish(self, tail_text=""):
+        """Returns the RenderedDocument for this head followed by tail_text.
+
+        The strong ETag is a hash of the body rather than the schedule version alone, since the
+        body also depends on timezone, base URL and the next event, and versions restart at 1."""
+        tail = tail_text.encode("utf-8")
+        compressor, digest = self._compressor.copy(), self._hash.copy()
+        digest.update(tail)
+        body = self.body + tail
+        return RenderedDocument(
+            body=body,
+            gzip=self.gzip + compressor.compress(tail) + compressor.flush(),
+            br=brotli.compress(body) if brotli else None,
+            etag=digest.hexdigest()[:32],
+            last_modified=datetime.now(timezone.utc).replace(microsecond=0),
+        )
+
+def render_document(text):
+    """Encodes text once and precompresses it so cache hits never compress on the request path."""
+    return DocumentHead(text).finish()
+
+class _CachedZone:
+    """DocumentCache's entries for one timezone."""
+
+    def __init__(self, target_timezone):
+        self.timezone = target_timezone
+        self.heads = OrderedDict() # (fmt, version, base_url, options, future races?) -> DocumentHead
+        self.documents = OrderedDict() # (fmt, version, base_url, options, time_key) -> _CachedDocument
+
+_CachedDocument = namedtuple("_CachedDocument", ["document", "render_head", "render_tail"])
+
+class DocumentCache:
+    """Memoizes rendered documents (XMLTV, M3U, JSON and iCalendar).
+
+    Every format is built from the parsed Schedule as a head, which only changes with the
+    schedule, timezone and request options (window, channels), and a tail that also depends on
+    "now" (each channel's next event, the "No upcoming races" branch). Tails only change when
+    a session starts, so documents are keyed on the number of sessions started so far (or the
+    local day once none are left) and stay valid between session boundaries; at a boundary,
+    BoundaryScheduler has advance() rebuild just the tails. Each timezone has its own LRU of
+    at most max_entries documents, and at most max_timezones timezones are kept, so requests
+    for many timezones can't push out each other's documents."""
+
+    def __init__(self, max_entries=32, max_timezones=MAX_TIMEZONES):
+        self.max_entries = max_entries
+        self.max_timezones = max_timezones
+        self.hits = 0
+        self.misses = 0
+        self._zones = OrderedDict() # str(timezone) -> _CachedZone
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def time_key(schedule, target_timezone, now):
+        """Identifies the stretch of time between two session boundaries that now falls into."""
+        if schedule is None:
+            return None
+        started = schedule.sessions_started(now)
+        if started < len(schedule.sessions):
+            return started
+        # No future sessions: the "No upcoming races" entry is pinned to the current local day
+        return datetime.fromtimestamp(now, target_timezone).strftime("%Y-%m-%d")
+
+    def get(self, fmt, schedule, target_timezone, base_url, options, render_head, render_tail=None, now=None):
+        """Returns the cached RenderedDocument for fmt. On a miss, render_head(now) and
+        render_tail(now) build the two parts of its text; formats that don't depend on "now"
+        pass no render_tail and are never rebuilt at boundaries."""
+        now = int(time.time()) if now is None else now
+        tz_key = str(target_timezone)
+        version = schedule.version if schedule else 0
+        time_key = self.time_key(schedule, target_timezone, now) if render_tail else None
+        key = (fmt, version, base_url, options, time_key)
+        with self._lock:
+            zone = self._zones.get(tz_key)
+            cached = zone.documents.get(key) if zone is not None else None
+            if cached is not None:
+                self._zones.move_to_end(tz_key)
+                zone.documents.move_to_end(key)
+                self.hits += 1
+                return cached.document
+            self.misses += 1
+            head_key = (fmt, version, base_url, options, bool(schedule) and schedule.has_future_races(now))
+            head = zone.heads.get(head_key) if zone is not None else None
+        with DOCUMENT_BUILD_SECONDS.labels(fmt).time():
+            head_text = render_head(now) if head is None else None
+            tail_text = render_tail(now) if render_tail else ""
+        with DOCUMENT_SERIALIZE_SECONDS.labels(fmt).time():
+            if head is None:
+                head = DocumentHead(head_text)
+            document = head.finish(tail_text)
+        with self._lock:
+            zone = self._zones.get(tz_key)
+            if zone is None:
+                zone = self._zones[tz_key] = _CachedZone(target_timezone)
+            self._zones.move_to_end(tz_key)
+            zone.heads[head_key] = head
+            zone.documents[key] = _CachedDocument(document, render_head, render_tail)
+            for entries in (zone.heads, zone.documents):
+                while len(entries) > self.max_entries:
+                    entries.popitem(last=False)
+            while len(self._zones) > self.max_timezones:
+                self._zones.popitem(last=False)
+        return document
+
+    def advance(self, schedule, now):
+        """Rebuilds the tail of every cached document for schedule that went stale at a session
+        boundary, so the first request after it is still a hit. Returns the number rebuilt."""
+        with self._lock:
+            stale = [(zone.timezone, key, cached) for zone in self._zones.values()
+                     for key, cached in zone.documents.items()
+                     if cached.render_tail and key[1] == schedule.version
+                     and key[4] != self.time_key(schedule, zone.timezone, now)]
+            for target_timezone, key, _ in stale:
+                self._zones[str(target_timezone)].documents.pop(key, None)
+        for target_timezone, (fmt, _, base_url, options, _), cached in stale:
+            self.get(fmt, schedule, target_timezone, base_url, options, cached.render_head, cached.render_tail, now)
+        return len(stale)
+
+    def on_schedule_change(self, schedule, changes):
+        """Drops every document and head rendered from an older schedule version. Only called when
+        a session actually changed, so refreshes returning the same data keep the whole cache."""
+        with self._lock:
+            for zone in self._zones.values():
+                for entries in (zone.documents, zone.heads): # Both keyed (fmt, version, ...)
+                    for key in [key for key in entries if key[1] != schedule.version]:
+                        del entries[key]
+
+    def timezones(self):
+        with self._lock:
+            return len(self._zones)
+
+document_cache = DocumentCache()
+
+class BoundaryScheduler:
+    """Wakes up at the start of each session, the only moments the time-dependent parts of the
+    documents change, and has the document cache rebuild those parts right away. A schedule
+    change (a rescheduled session may move the next boundary) wakes it early; otherwise it
+    sleeps at most max_sleep seconds at a time."""
+
+    def __init__(self, store, cache, max_sleep=3600):
+        self.store = store
+        self.cache = cache
+        self.max_sleep = max_sleep
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def on_schedule_change(self, schedule, changes):
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            schedule = self.store.schedule
+            boundary = schedule.next_boundary(time.time()) if schedule else None
+            timeout = self.max_sleep if boundary is None else min(max(boundary - time.time(), 0), self.max_sleep)
+            self._wake.wait(timeout)
+            self._wake.clear()
+            if self._stop.is_set() or boundary is None or time.time() < boundary or self.store.schedule is not schedule:
+                continue
+            rebuilt = self.cache.advance(schedule, boundary)
+            BOUNDARY_REBUILDS.inc(rebuilt)
+            logger.debug(f"Session boundary at {boundary}: rebuilt {rebuilt} cached documents")
+
+    def start(self):
+        """Starts the scheduler thread (idempotent)."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="boundary-scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+boundary_scheduler = BoundaryScheduler(schedule_store, document_cache)
+
+# Downstream caches only hear about a refresh when a session actually changed
+schedule_store.subscribe(document_cache.on_schedule_change)
+schedule_store.subscribe(boundary_scheduler.on_schedule_change)
+
+# Seconds clients may reuse a guide before revalidating (revalidation is a cheap 304)
+EPG_MAX_AGE = 300
+# Channel icons only change if the artwork does, so clients may keep them for a day
+ICON_MAX_AGE = 86400
+
+def conditional_response(response, etag, last_modified, max_age):
+    """Adds validators and Cache-Control to response and turns it into a 304 if the client's copy is current."""
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
+
+def document_response(document, mimetype, max_age=EPG_MAX_AGE):
+    """Builds a response for a RenderedDocument, picking the best precompressed variant the client accepts."""
+    accepted = request.accept_encodings
+    etag = document.etag
+    if document.br is not None and accepted['br']:
+        response = Response(document.br, mimetype=mimetype)
+        response.headers['Content-Encoding'] = 'br'
+        etag += "-br" # Each encoding is a different representation and needs its own strong ETag
+    elif accepted['gzip']:
+        response = Response(document.gzip, mimetype=mimetype)
+        response.headers['Content-Encoding'] = 'gzip'
+        etag += "-gzip"
+    else:
+        response = Response(document.body, mimetype=mimetype)
+    response.headers['Vary'] = 'Accept-Encoding'
+    return conditional_response(response, etag, document.last_modified, max_age)
+
+def image_response(png_bytes):
+    """Builds a cacheable PNG response, answering 304 when the client already has these bytes."""
+    response = Response(png_bytes, mimetype='image/png')
+    return conditional_response(response, hashlib.sha256(png_bytes).hexdigest()[:32], STARTED_AT, ICON_MAX_AGE)
+
+def _parse_query_time(value, target_timezone):
+    """Parses an ISO 8601 date or date-time query parameter into an epoch. Values without a UTC
+    offset are taken to be in target_timezone."""
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=target_timezone)
+    return int(parsed.timestamp())
+
+def parse_window(args, target_timezone):
+    """Turns the from/to/days query parameters into a (start, end) epoch window for
+    Schedule.programmes_between, or None when none are given. days counts from the start of
+    the current local day unless from or to is given. Raises ValueError on bad values."""
+    start, end, days = args.get('from'), args.get('to'), args.get('days')
+    if start is None and end is None and days is None:
+        return None
+    start = _parse_query_time(start, target_timezone) if start else None
+    end = _parse_query_time(end, target_timezone) if end else None
+    if days is not None:
+        days = int(days)
+        if days <= 0:
+            raise ValueError("days must be positive")
+        if start is None and end is not None:
+            start = end - days * 86400
+        else:
+            if start is None:
+                today = datetime.now(target_timezone).replace(hour=0, minute=0, second=0, microsecond=0)
+                start = int(today.timestamp())
+            end = end if end is not None else start + days * 86400
+    if start is not None and end is not None and end <= start:
+        raise ValueError("to must be after from")
+    return (start, end)
+
+def request_timezone(tz_name=None):
+    """The timezone asked for in the URL path or the tz query parameter, else the configured one.
+    Raises ValueError for unknown names."""
+    tz_name = tz_name or request.args.get('tz')
+    return lookup_timezone(tz_name) if tz_name else app.config['TARGET_TIMEZONE']
+
+def _request_context(tz_name=None):
+    """Returns (schedule, target_timezone, window, base_url) for a guide request. Raises
+    ValueError, with the message for the 400 response, for a bad timezone or window."""
+    schedule = schedule_store.get() # Never touches the network; refreshed in the background
+    target_timezone = request_timezone(tz_name)
+    try:
+        window = parse_window(request.args, target_timezone)
+    except ValueError:
+        # Fixed message: the parse error would repeat the raw from/to value back to the client
+        raise ValueError("Invalid date window: from/to must be ISO 8601 times, days a positive number, "
+                         "and to after from") from None
     # Get the base URL for generating absolute icon URLs
     base_url = request.url_root.rstrip('/') # e.g., http://localhost:5001
-    xml_data = generate_xmltv(races, app.config['TARGET_TIMEZONE'], base_url)
-    return Response(xml_data, mimetype='application/xml')
+    return schedule, target_timezone, window, base_url
+
+@app.route('/epg.xml')
+@app.route('/tz/<path:tz_name>/epg.xml')
+def epg(tz_name=None):
+    """The main EPG endpoint. The timezone can be chosen per request, as /tz/Europe/London/epg.xml
+    or /epg.xml?tz=Europe/London, and optional from/to/days query parameters limit the programmes
+    to a window."""
+    try:
+        schedule, target_timezone, window, base_url = _request_context(tz_name)
+    except ValueError as e:
+        return Response(str(e), status=400, mimetype='text/plain')
+    channels = app.config.get('CHANNELS', DEFAULT_CHANNELS)
+    document = document_cache.get(
+        "xmltv", schedule, target_timezone, base_url, (window, channels),
+        lambda now: "".join(iter_xmltv_head(schedule, target_timezone, window, channels, now)),
+        lambda now: "".join(iter_xmltv_tail(schedule, target_timezone, base_url, channels, now)))
+    return document_response(document, 'application/xml')
+
+def _channel_icon_url(channel, schedule, base_url, now):
+    """The channel's fixed icon, or the flag icon of its next event as in the XMLTV <channel>."""
+    if channel.icon:
+        return channel.icon
+    next_event = schedule.next_session(now, channel) if schedule else None
+    return f"{base_url}/channel_icon.png" + (f"?country_code={next_event.country_code}" if next_event else "")
+
+def _m3u_attr(value):
+    return value.replace('"', "'").replace("\n", " ")
+
+def m3u_head(base_url, epg_path="/epg.xml"):
+    epg_url = _m3u_attr(base_url + epg_path)
+    return f'#EXTM3U url-tvg="{epg_url}" x-tvg-url="{epg_url}"\n'
+
+def m3u_tail(schedule, base_url, channels=DEFAULT_CHANNELS, now=None):
+    """The playlist entries: one per channel that has a stream URL, with its next event's icon."""
+    now = int(time.time()) if now is None else now
+    lines = []
+    for channel in channels:
+        if not channel.stream:
+            continue
+        lines.append(f'#EXTINF:-1 tvg-id="{_m3u_attr(channel.id)}" tvg-name="{_m3u_attr(channel.name)}" '
+                     f'tvg-logo="{_m3u_attr(_channel_icon_url(channel, schedule, base_url, now))}" '
+                     f'group-title="Formula 1",{channel.name}\n')
+        lines.append(channel.stream + "\n")
+    return "".join(lines)
+
+def _session_json(p, target_timezone, channels):
+    return {
+        "kind": p.kind.api_key,
+        "name": p.kind.display_name,
+        "title": p.title(target_timezone),
+        "race": p.race_name,
+        "circuit": p.circuit_name,
+        "locality": p.locality,
+        "country": p.country,
+        "country_code": p.country_code,
+        "start": datetime.fromtimestamp(p.start, target_timezone).isoformat(),
+        "end": datetime.fromtimestamp(p.end, target_timezone).isoformat(),
+        "channels": [channel.id for channel in channels if channel.matches(p)],
+    }
+
+def schedule_json_head(schedule, target_timezone, window=None, channels=DEFAULT_CHANNELS):
+    """The JSON document up to its closing brace: every session (no placeholders) in window with
+    local ISO 8601 times and the channels it is routed to."""
+    programmes = []
+    if schedule:
+        programmes = schedule.programmes if window is None else schedule.programmes_between(*window)
+    return json.dumps({
+        "timezone": str(target_timezone),
+        "content_hash": schedule.content_hash if schedule else None, # Unlike version, the same in every worker
+        "sessions": [_session_json(p, target_timezone, channels) for p in programmes if not p.is_placeholder],
+    }, separators=(",", ":"), ensure_ascii=False)[:-1]
+
+def schedule_json_tail(schedule, target_timezone, channels=DEFAULT_CHANNELS, now=None):
+    """The last member of the JSON document, the next upcoming session, and its closing brace."""
+    next_event = schedule.next_session(int(time.time()) if now is None else now) if schedule else None
+    next_json = _session_json(next_event, target_timezone, channels) if next_event else None
+    return ',"next":' + json.dumps(next_json, separators=(",", ":"), ensure_ascii=False) + "}"
+
+def _ics_text(value):
+    return value.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+def _ics_fold(line):
+    """Folds a content line to 75 octets as RFC 5545 requires, without splitting UTF-8 sequences."""
+    encoded = line.encode("utf-8")
+    if len(encoded) <= 75:
+        return line
+    parts, limit = [], 75
+    while encoded:
+        cut = min(limit, len(encoded))
+        while cut < len(encoded) and (encoded[cut] & 0xC0) == 0x80: # Don't cut inside a character
+            cut -= 1
+        parts.append(encoded[:cut].decode("utf-8"))
+        encoded = encoded[cut:]
+        limit = 74 # Continuation lines start with a space
+    return "\r\n ".join(parts)
+
+def _ics_time(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+def generate_ics(schedule, window=None):
+    """Generates an iCalendar feed with one event per session, in UTC. Event UIDs are the
+    session's season, round and kind, so a rescheduled session updates the same event."""
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//F1 EPG Server//EN", "CALSCALE:GREGORIAN",
+             "METHOD:PUBLISH", "X-WR-CALNAME:Formula 1"]
+    programmes = []
+    if schedule:
+        programmes = schedule.programmes if window is None else schedule.programmes_between(*window)
+    for p in programmes:
+        if p.is_placeholder:
+            continue
+        lines += [
+            "BEGIN:VEVENT",
+            f"UID:{_ics_text(f'{p.season}-{p.round}-{p.kind.api_key}')}@f1-epg-server",
+            f"DTSTAMP:{_ics_time(schedule.updated_at)}", # From the snapshot, so the same in every worker
+            f"DTSTART:{_ics_time(p.start)}",
+            f"DTEND:{_ics_time(p.end)}",
+            f"SUMMARY:{_ics_text(p.title(timezone.utc))}",
+            f"DESCRIPTION:{_ics_text(p.desc)}",
+            f"LOCATION:{_ics_text(f'{p.circuit_name}, {p.locality}, {p.country}')}",
+            "END:VEVENT",
+        ]
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(_ics_fold(line) for line in lines) + "\r\n"
+
+@app.route('/playlist.m3u')
+@app.route('/tz/<path:tz_name>/playlist.m3u')
+def playlist(tz_name=None):
+    """M3U playlist for IPTV clients, referencing the guide in the same timezone as its url-tvg."""
+    schedule = schedule_store.get()
+    try:
+        target_timezone = request_timezone(tz_name)
+    except ValueError as e:
+        return Response(str(e), status=400, mimetype='text/plain')
+    base_url = request.url_root.rstrip('/')
+    channels = app.config.get('CHANNELS', DEFAULT_CHANNELS)
+    epg_path = "/epg.xml" if target_timezone is app.config['TARGET_TIMEZONE'] else f"/tz/{target_timezone}/epg.xml"
+    document = document_cache.get("m3u", schedule, target_timezone, base_url, channels,
+                                  lambda now: m3u_head(base_url, epg_path),
+                                  lambda now: m3u_tail(schedule, base_url, channels, now))
+    return document_response(document, 'audio/x-mpegurl')
+
+@app.route('/schedule.json')
+@app.route('/tz/<path:tz_name>/schedule.json')
+def schedule_json(tz_name=None):
+    """JSON schedule API. Takes the same timezone and from/to/days parameters as /epg.xml."""
+    try:
+        schedule, target_timezone, window, _ = _request_context(tz_name)
+    except ValueError as e:
+        return Response(str(e), status=400, mimetype='text/plain')
+    channels = app.config.get('CHANNELS', DEFAULT_CHANNELS)
+    document = document_cache.get("json", schedule, target_timezone, "", (window, channels),
+                                  lambda now: schedule_json_head(schedule, target_timezone, window, channels),
+                                  lambda now: schedule_json_tail(schedule, target_timezone, channels, now))
+    return document_response(document, 'application/json')
+
+@app.route('/schedule.ics')
+def schedule_ics():
+    """iCalendar feed of every session, in UTC. tz only changes how from/to/days are read."""
+    try:
+        schedule, _, window, _ = _request_context()
+    except ValueError as e:
+        return Response(str(e), status=400, mimetype='text/plain')
+    document = document_cache.get("ics", schedule, timezone.utc, "", window, lambda now: generate_ics(schedule, window))
+    return document_response(document, 'text/calendar')
 
 F1_LOGO_URL = "https://www.formula1.com/etc/designs/fom-website/images/f1_logo.png"
 FLAG_BASE_URL = "https://flagcdn.com/w160/" # Higher resolution flags
@@ -365,93 +1465,335 @@ COUNTRY_COLORS = {
     # Add more as needed
 }
 
+# Output channel icon geometry
+ICON_WIDTH = 200
+ICON_HEIGHT = 100
+ICON_PADDING = 5
+LOGO_HEIGHT = int(ICON_HEIGHT * 0.4) # F1 logo is 40% of the icon height
+FLAG_HEIGHT = int(ICON_HEIGHT * 0.3) # Flag is 30% of the icon height
+
+def _resize_to_height(img, height):
+    """Resizes img to height, maintaining aspect ratio."""
+    from PIL import Image
+    width = int(img.width * (height / img.height))
+    return img.resize((width, height), Image.LANCZOS)
+
+class AssetStore:
+    """Local store for the F1 logo and country flags used by the channel icons.
+
+    Each asset is downloaded at most once and kept in assets_dir (which can also be vendored
+    ahead of time), then decoded and resized to its final icon size once and kept in memory."""
+
+    def __init__(self, assets_dir="assets", flag_retry_interval=300):
+        self.assets_dir = assets_dir
+        self.flag_retry_interval = flag_retry_interval
+        self._images = {}
+        self._flag_retry_at = {} # country_code -> when to try a flag that failed to download again
+        self._lock = threading.Lock()
+
+    def _save(self, name, content):
+        try:
+            atomic_write(os.path.join(self.assets_dir, name), content)
+        except OSError as e:
+            logger.warning(f"Could not save asset {name} to {self.assets_dir}: {e}")
+
+    def _read(self, name, url):
+        """Returns the bytes of asset name, downloading it from url into assets_dir if missing."""
+        path = os.path.join(self.assets_dir, name)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                return f.read()
+        response = http_client.get(url)
+        response.raise_for_status()
+        self._save(name, response.content)
+        return response.content
+
+    def _sources(self, country_codes):
+        yield "f1_logo.png", F1_LOGO_URL
+        for country_code in country_codes:
+            yield f"flags/{country_code}.png", f"{FLAG_BASE_URL}{country_code}.png"
+
+    async def _prefetch(self, country_codes):
+        import asyncio
+        missing = [(name, url) for name, url in self._sources(country_codes)
+                   if not os.path.exists(os.path.join(self.assets_dir, name))]
+        responses = await asyncio.gather(*(http_client.get_async(url) for _, url in missing), return_exceptions=True)
+        for (name, url), response in zip(missing, responses):
+            if isinstance(response, Exception) or not response.ok:
+                logger.warning(f"Could not download {url}: {response if isinstance(response, Exception) else response.status_code}")
+                continue
+            self._save(name, response.content)
+
+    def prefetch(self, country_codes):
+        """Downloads the logo and any missing flags for country_codes concurrently rather than one after another."""
+        import asyncio
+        asyncio.run(self._prefetch(country_codes))
+
+    def _image(self, key, name, url, height):
+        with self._lock:
+            if key in self._images:
+                return self._images[key]
+        from PIL import Image
+        img = _resize_to_height(Image.open(io.BytesIO(self._read(name, url))).convert("RGBA"), height)
+        with self._lock:
+            self._images[key] = img
+        return img
+
+    def logo(self):
+        """The F1 logo, resized for the channel icon. Raises RequestException if it can't be obtained."""
+        return self._image("logo", "f1_logo.png", F1_LOGO_URL, LOGO_HEIGHT)
+
+    def flag_missing(self, country_code):
+        """Whether the flag for country_code failed to download and isn't due to be tried again yet."""
+        with self._lock:
+            return time.time() < self._flag_retry_at.get(country_code, 0)
+
+    def flag(self, country_code):
+        """The resized flag for country_code, or None if it can't be downloaded. After a failed
+        download, the flag is only tried again once flag_retry_interval seconds have passed."""
+        if self.flag_missing(country_code):
+            return None
+        try:
+            return self._image(f"flag_{country_code}", f"flags/{country_code}.png",
+                               f"{FLAG_BASE_URL}{country_code}.png", FLAG_HEIGHT)
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Could not download flag for {country_code}: {e}")
+            with self._lock:
+                self._flag_retry_at[country_code] = time.time() + self.flag_retry_interval
+            return None
+
+asset_store = AssetStore()
+
+@ICON_RENDER_SECONDS.time()
+def render_channel_icon(country_code):
+    """Renders the channel icon for country_code (or the plain F1 logo icon if None) to PNG bytes."""
+    # Pillow is only loaded once an icon has to be rendered, and not at all with prerendered icons
+    from PIL import Image
+
+    # Determine background color
+    bg_color_hex = COUNTRY_COLORS.get(country_code, "#000000") if country_code else "#000000" # Default to black
+    # Convert hex to RGB
+    bg_color_rgb = tuple(int(bg_color_hex.lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
+
+    f1_logo_img = asset_store.logo()
+    # Only show a flag if a country_code is provided
+    flag_img = asset_store.flag(country_code) if country_code else None
+
+    combined_img = Image.new("RGBA", (ICON_WIDTH, ICON_HEIGHT), bg_color_rgb + (255,)) # Opaque background
+
+    # Create a new transparent image for the content
+    content_height = LOGO_HEIGHT + (FLAG_HEIGHT + ICON_PADDING if flag_img else 0)
+    content_img = Image.new("RGBA", (ICON_WIDTH, content_height), (0,0,0,0))
+
+    # Paste F1 logo onto the content image
+    f1_logo_x = (ICON_WIDTH - f1_logo_img.width) // 2
+    f1_logo_y_in_content = 0 if flag_img else (content_height - LOGO_HEIGHT) // 2
+    content_img.paste(f1_logo_img, (f1_logo_x, f1_logo_y_in_content), f1_logo_img)
+
+    # Paste flag below the F1 logo if it exists
+    if flag_img:
+        flag_x = (ICON_WIDTH - flag_img.width) // 2
+        flag_y = LOGO_HEIGHT + ICON_PADDING
+        content_img.paste(flag_img, (flag_x, flag_y), flag_img)
+
+    # Calculate position to paste the content image onto the background for vertical centering
+    paste_y = (ICON_HEIGHT - content_height) // 2
+    combined_img.paste(content_img, (0, paste_y), content_img)
+
+    img_byte_arr = io.BytesIO()
+    combined_img.save(img_byte_arr, format='PNG')
+    return img_byte_arr.getvalue()
+
+def canonical_country_code(country_code):
+    """Normalizes a country_code query parameter, returning None for anything not in COUNTRY_COLORS.
+
+    Only canonical codes are used as cache keys, so arbitrary query strings can't grow the cache."""
+    if not country_code:
+        return None
+    country_code = country_code.strip().lower()
+    return country_code if country_code in COUNTRY_COLORS else None
+
+# Bump when the icon layout or assets change, so icons rendered before aren't read from disk
+ICON_RENDER_VERSION = 2
+
+def _icon_file_name(country_code):
+    return f"{country_code or 'default'}-v{ICON_RENDER_VERSION}.png"
+
+def _icon_complete(country_code):
+    """Whether an icon rendered for country_code now has everything on it, i.e. isn't the
+    flagless fallback used while its flag can't be downloaded."""
+    return country_code is None or not asset_store.flag_missing(country_code)
+
+def _load_or_render_icon(country_code):
+    """Reads the icon from the shared on-disk icon cache (ICON_CACHE_DIR), rendering and storing it
+    there if no worker process has yet. Without ICON_CACHE_DIR the icon is just rendered. With
+    PRERENDERED_ICONS, icons are only ever read from that directory (see render_icons). A flagless
+    fallback icon is never stored."""
+    prerendered = app.config.get('PRERENDERED_ICONS')
+    if prerendered:
+        path = os.path.join(prerendered, _icon_file_name(country_code))
+        if not os.path.exists(path):
+            path = os.path.join(prerendered, _icon_file_name(None)) # Plain F1 logo icon
+        with open(path, "rb") as f:
+            return f.read()
+    cache_dir = app.config.get('ICON_CACHE_DIR')
+    if not cache_dir:
+        return render_channel_icon(country_code)
+    path = os.path.join(cache_dir, _icon_file_name(country_code))
+    with file_lock(f"{path}.lock"):
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                return f.read()
+        png = render_channel_icon(country_code)
+        if _icon_complete(country_code):
+            try:
+                atomic_write(path, png)
+            except OSError as e: # The disk cache is best effort, like the lock above
+                logger.warning(f"Could not save icon to {cache_dir}: {e}")
+        return png
+
+def get_channel_icon(country_code):
+    """Returns the PNG for a canonical country_code from image_cache, rendering it once on a miss.
+    A flagless fallback isn't cached, so the icon is rendered again once its flag can be retried."""
+    return image_cache.get_or_create(country_code, lambda: _load_or_render_icon(country_code),
+                                     cacheable=lambda png: _icon_complete(country_code))
+
+def prerender_icons(workers=4):
+    """Fetches the icon assets and renders the icons for every country in COUNTRY_COLORS (and the
+    plain icon) in the background."""
+    def run():
+        asset_store.prefetch(COUNTRY_COLORS)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="icon-prerender") as executor:
+            for country_code in [None] + list(COUNTRY_COLORS):
+                executor.submit(get_channel_icon, country_code)
+    threading.Thread(target=run, name="icon-prerender", daemon=True).start()
+
+def render_icons(directory):
+    """Renders the icon for every country in COUNTRY_COLORS (and the plain icon) into directory,
+    e.g. when building a container image, so the server can run with --prerendered-icons and
+    without Pillow. Raises if the F1 logo can't be obtained."""
+    os.makedirs(directory, exist_ok=True)
+    asset_store.prefetch(COUNTRY_COLORS)
+    for country_code in [None] + list(COUNTRY_COLORS):
+        atomic_write(os.path.join(directory, _icon_file_name(country_code)), render_channel_icon(country_code))
+    return len(COUNTRY_COLORS) + 1
+
 @app.route('/channel_icon.png')
 def channel_icon():
-    country_code = request.args.get('country_code')
-    
-    # Check cache first
-    cache_key = f"channel_icon_{country_code or 'no_country'}"
-    if cache_key in image_cache:
-        return send_file(io.BytesIO(image_cache[cache_key]), mimetype='image/png')
+    country_code = canonical_country_code(request.args.get('country_code'))
 
     try:
-        # Determine background color
-        bg_color_hex = COUNTRY_COLORS.get(country_code, "#000000") if country_code else "#000000" # Default to black
-        # Convert hex to RGB
-        bg_color_rgb = tuple(int(bg_color_hex.lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
-
-        # Download F1 logo
-        f1_logo_response = requests.get(F1_LOGO_URL)
-        f1_logo_response.raise_for_status()
-        f1_logo_img = Image.open(io.BytesIO(f1_logo_response.content)).convert("RGBA")
-
-        # Download country flag only if a country_code is provided
-        flag_img = None
-        if country_code:
-            try:
-                flag_url = f"{FLAG_BASE_URL}{country_code}.png"
-                flag_response = requests.get(flag_url)
-                flag_response.raise_for_status()
-                flag_img = Image.open(io.BytesIO(flag_response.content)).convert("RGBA")
-            except requests.exceptions.RequestException as e:
-                print(f"Could not download flag for {country_code}: {e}")
-
-        # Define output image size
-        output_width = 200
-        output_height = 100
-        combined_img = Image.new("RGBA", (output_width, output_height), bg_color_rgb + (255,)) # Opaque background
-
-        # Define padding
-        padding = 5
-
-        # Resize F1 logo (e.g., 40% of output height, maintain aspect ratio)
-        f1_logo_height = int(output_height * 0.4)
-        f1_logo_width = int(f1_logo_img.width * (f1_logo_height / f1_logo_img.height))
-        f1_logo_img = f1_logo_img.resize((f1_logo_width, f1_logo_height), Image.LANCZOS)
-        
-        # Create a new transparent image for the content
-        content_height = f1_logo_height + (int(output_height * 0.3) + padding if flag_img else 0)
-        content_img = Image.new("RGBA", (output_width, content_height), (0,0,0,0))
-
-        # Paste F1 logo onto the content image
-        f1_logo_x = (output_width - f1_logo_width) // 2
-        f1_logo_y_in_content = 0 if flag_img else (content_height - f1_logo_height) // 2
-        content_img.paste(f1_logo_img, (f1_logo_x, f1_logo_y_in_content), f1_logo_img)
-
-        # Paste flag below the F1 logo if it exists
-        if flag_img:
-            flag_height = int(output_height * 0.3)
-            flag_width = int(flag_img.width * (flag_height / flag_img.height))
-            flag_img = flag_img.resize((flag_width, flag_height), Image.LANCZOS)
-            flag_x = (output_width - flag_width) // 2
-            flag_y = f1_logo_height + padding
-            content_img.paste(flag_img, (flag_x, flag_y), flag_img)
-
-        # Calculate position to paste the content image onto the background for vertical centering
-        paste_y = (output_height - content_height) // 2
-        
-        # Paste the content image onto the background
-        combined_img.paste(content_img, (0, paste_y), content_img)
-
-        # Save to BytesIO object
-        img_byte_arr = io.BytesIO()
-        combined_img.save(img_byte_arr, format='PNG')
-        img_byte_arr = img_byte_arr.getvalue()
-
-        # Cache the image
-        image_cache[cache_key] = img_byte_arr
-
-        return send_file(io.BytesIO(img_byte_arr), mimetype='image/png')
-
+        return image_response(get_channel_icon(country_code))
     except requests.exceptions.RequestException as e:
-        print(f"Error downloading image: {e}")
+        logger.error(f"Error downloading image: {e}")
         # Fallback to a default image or error image
         return Response("Error generating icon", status=500)
     except Exception as e:
-        print(f"Error processing image: {e}")
+        logger.exception(f"Error processing image: {e}")
         return Response("Error generating icon", status=500)
 
 
+class StatsCollector:
+    """Exports cache and schedule state that already lives on the stores, read at scrape time."""
+
+    def collect(self):
+        requests_total = CounterMetricFamily("f1epg_cache_requests", "Cache lookups by result",
+                                             labels=["cache", "result"])
+        requests_total.add_metric(["schedule", "fresh"], schedule_store.fresh_hits)
+        requests_total.add_metric(["schedule", "stale"], schedule_store.stale_hits)
+        requests_total.add_metric(["documents", "hit"], document_cache.hits)
+        requests_total.add_metric(["documents", "miss"], document_cache.misses)
+        image_stats = image_cache.stats()
+        requests_total.add_metric(["image", "hit"], image_stats["hits"])
+        requests_total.add_metric(["image", "miss"], image_stats["misses"])
+        yield requests_total
+        yield CounterMetricFamily("f1epg_image_cache_evictions", "Icons evicted from image_cache",
+                                  value=image_stats["evictions"])
+        yield GaugeMetricFamily("f1epg_image_cache_bytes", "Total size of the icons in image_cache",
+                                value=image_stats["bytes"])
+        age = GaugeMetricFamily("f1epg_schedule_age_seconds",
+                                "Seconds since the served schedule was last confirmed upstream (NaN if never)")
+        age.add_metric([], time.time() - schedule_store.fetched_at if schedule_store.fetched_at else float("nan"))
+        yield age
+        yield GaugeMetricFamily("f1epg_schedule_version", "Version of the served schedule",
+                                value=schedule_store.version)
+        info = GaugeMetricFamily("f1epg_schedule_info", "Source and content hash of the held schedule",
+                                 labels=["source", "content_hash"])
+        info.add_metric([schedule_store.source.name, schedule_store.content_hash or ""], 1)
+        yield info
+        yield GaugeMetricFamily("f1epg_schedule_sessions", "Sessions in the served schedule",
+                                value=len(schedule_store.schedule.sessions) if schedule_store.schedule else 0)
+        yield GaugeMetricFamily("f1epg_document_cache_timezones", "Timezones with rendered documents cached",
+                                value=document_cache.timezones())
+
+REGISTRY.register(StatsCollector())
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics. Histograms and counters are per worker process unless
+    PROMETHEUS_MULTIPROC_DIR is set before start-up, in which case they are aggregated."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(StatsCollector())
+        return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(REGISTRY), mimetype=CONTENT_TYPE_LATEST)
+
+def _parse_timezone(name):
+    try:
+        return lookup_timezone(name)
+    except ValueError:
+        logger.error(f"Unknown timezone '{name}'. Defaulting to UTC.")
+        return timezone.utc
+
+def create_app(timezone_name=None, refresh_interval=None, snapshot=None, assets_dir=None, cache_dir=None,
+               log_level=None, channels=None, prerendered_icons=None, source=None):
+    """Configures the app and starts its background work (schedule refresher, icon pre-render).
+
+    Also serves as the WSGI app factory for production servers, e.g.
+    gunicorn --workers 4 --threads 4 'app:create_app()'. Arguments that are not given fall back
+    to the F1_EPG_TIMEZONE, F1_EPG_REFRESH_INTERVAL, F1_EPG_SNAPSHOT, F1_EPG_ASSETS_DIR,
+    F1_EPG_CACHE_DIR, F1_EPG_LOG_LEVEL, F1_EPG_CHANNELS, F1_EPG_PRERENDERED_ICONS and F1_EPG_SOURCE
+    environment variables, then to the command-line defaults. Worker processes share the schedule snapshot
+    and the rendered icons in cache_dir, so only one of them fetches or renders each."""
+    env = os.environ.get
+    logging.basicConfig(level=(log_level or env('F1_EPG_LOG_LEVEL', 'INFO')).upper(), format=LOG_FORMAT)
+    app.config['TARGET_TIMEZONE'] = _parse_timezone(timezone_name or env('F1_EPG_TIMEZONE', 'America/New_York'))
+    channels = channels or env('F1_EPG_CHANNELS')
+    app.config['CHANNELS'] = load_channels(channels) if channels else DEFAULT_CHANNELS
+    app.config['ICON_CACHE_DIR'] = os.path.join(cache_dir or env('F1_EPG_CACHE_DIR', 'cache'), 'icons')
+    os.makedirs(app.config['ICON_CACHE_DIR'], exist_ok=True)
+
+    schedule_store.source = make_source(source or env('F1_EPG_SOURCE', 'jolpica'))
+    schedule_store.refresh_interval = refresh_interval or int(env('F1_EPG_REFRESH_INTERVAL', 900))
+    schedule_store.snapshot_path = snapshot or env('F1_EPG_SNAPSHOT', 'schedule_snapshot.json')
+    if schedule_store.schedule is None and schedule_store.load_snapshot():
+        logger.info(f"Loaded {len(schedule_store.races)} races from snapshot {schedule_store.snapshot_path}")
+    schedule_store.start()
+    boundary_scheduler.start()
+
+    asset_store.assets_dir = assets_dir or env('F1_EPG_ASSETS_DIR', 'assets')
+    app.config['PRERENDERED_ICONS'] = prerendered_icons or env('F1_EPG_PRERENDERED_ICONS')
+    if not app.config['PRERENDERED_ICONS']:
+        prerender_icons()
+    return app
+
+def run_production(host, port, workers, threads, **settings):
+    """Serves the app with gunicorn, each worker process calling create_app(**settings) after forking."""
+    from gunicorn.app.base import BaseApplication # Only needed in production mode
+
+    class F1EPGApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{host}:{port}")
+            self.cfg.set("workers", workers)
+            self.cfg.set("threads", threads)
+
+        def load(self):
+            return create_app(**settings)
+
+    F1EPGApplication().run()
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="F1 EPG Server")
     parser.add_argument('--port', type=int, default=5001,
@@ -460,12 +1802,55 @@ if __name__ == '__main__':
                         help='Timezone for EPG output (e.g., Europe/London, America/New_York). Default: America/New_York')
     parser.add_argument('--host', type=str, default='0.0.0.0',
                         help='Host to run the Flask server on (default: 0.0.0.0)')
+    parser.add_argument('--refresh-interval', type=int, default=900,
+                        help='Seconds between background schedule refreshes (default: 900)')
+    parser.add_argument('--snapshot', type=str, default='schedule_snapshot.json',
+                        help='Path of the on-disk schedule snapshot loaded at startup (default: schedule_snapshot.json)')
+    parser.add_argument('--assets-dir', type=str, default='assets',
+                        help='Directory holding the downloaded (or vendored) F1 logo and flag images (default: assets)')
+    parser.add_argument('--cache-dir', type=str, default='cache',
+                        help='Directory for rendered assets shared between worker processes (default: cache)')
+    parser.add_argument('--prewarm', type=str, default=None,
+                        help='JSON file (Jolpica response or list of races) to seed the schedule snapshot from, e.g. for air-gapped installs')
+    parser.add_argument('--channels', type=str, default=None,
+                        help='JSON file defining the EPG channels and which sessions go to each (default: one channel with everything)')
+    parser.add_argument('--log-level', type=str, default='INFO',
+                        help='Logging level: DEBUG, INFO, WARNING or ERROR (default: INFO)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Number of gunicorn worker processes; 0 runs the Flask development server (default: 0)')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='Threads per gunicorn worker process (default: 4)')
+    parser.add_argument('--prerendered-icons', type=str, default=None,
+                        help='Directory of icons made with --render-icons; serve only those and never load Pillow')
+    parser.add_argument('--source', type=str, default='jolpica',
+                        help='Schedule source: jolpica, the URL of a Jolpica mirror (e.g. http://mirror/ergast/f1/{year}.json) '
+                             'or a JSON file or directory of <year>.json files (default: jolpica)')
+    parser.add_argument('--render-icons', type=str, default=None, metavar='DIR',
+                        help='Render every channel icon into DIR (e.g. at image build time) and exit')
     args = parser.parse_args()
 
-    try:
-        app.config['TARGET_TIMEZONE'] = pytz.timezone(args.timezone)
-    except pytz.exceptions.UnknownTimeZoneError:
-        print(f"Error: Unknown timezone '{args.timezone}'. Defaulting to UTC.")
-        app.config['TARGET_TIMEZONE'] = pytz.utc
+    logging.basicConfig(level=args.log_level.upper(), format=LOG_FORMAT)
+    if args.render_icons:
+        asset_store.assets_dir = args.assets_dir
+        try:
+            logger.info(f"Rendered {render_icons(args.render_icons)} icons into {args.render_icons}")
+        except Exception as e:
+            logger.error(f"Could not render icons into '{args.render_icons}': {e}")
+            sys.exit(1)
+        sys.exit(0)
+    if args.prewarm:
+        schedule_store.snapshot_path = args.snapshot
+        try:
+            schedule_store.load(load_races_file(args.prewarm))
+            schedule_store.save_snapshot()
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error(f"Could not prewarm schedule from '{args.prewarm}': {e}")
 
-    app.run(host=args.host, port=args.port)
+    settings = dict(timezone_name=args.timezone, refresh_interval=args.refresh_interval, snapshot=args.snapshot,
+                    assets_dir=args.assets_dir, cache_dir=args.cache_dir, log_level=args.log_level,
+                    channels=args.channels, prerendered_icons=args.prerendered_icons, source=args.source)
+    if args.workers > 0:
+        run_production(args.host, args.port, args.workers, args.threads, **settings)
+    else:
+        create_app(**settings)
+        app.run(host=args.host, port=args.port)
@@ -0,0 +1,85 @@
+"""In-process benchmarks for schedule parsing, XMLTV rendering and channel icon rendering.
+
+Usage: python benchmarks/bench_render.py [--iterations N] [--output bench_render.json]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from common import fixture_sets, percentile, write_results, write_stub_assets
+
+import app
+
+def measure(fn, iterations):
+    """Runs fn iterations times, returning latency stats in milliseconds."""
+    fn() # Warm-up, excluded from the samples
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return {
+        "iterations": iterations,
+        "mean_ms": round(sum(samples) / len(samples), 4),
+        "p50_ms": round(percentile(samples, 50), 4),
+        "p99_ms": round(percentile(samples, 99), 4),
+    }
+
+def bench_xmltv(races, iterations, timezone):
+    schedule = app.Schedule.from_races(races, version=1)
+    cache = app.DocumentCache()
+    window_start = schedule.starts[len(schedule.starts) // 2]
+    window = (window_start, window_start + 7 * 86400)
+    head = lambda now: "".join(app.iter_xmltv_head(schedule, timezone, now=now))
+    tail = lambda now: "".join(app.iter_xmltv_tail(schedule, timezone, "http://localhost:5001", now=now))
+    cached_head = app.DocumentHead(head(None))
+    return {
+        "programmes": len(schedule.programmes),
+        "parse": measure(lambda: app.Schedule.from_races(races), iterations),
+        "generate_xmltv": measure(lambda: app.generate_xmltv(schedule, timezone, "http://localhost:5001"), iterations),
+        "generate_xmltv_7_day_window": measure(
+            lambda: app.generate_xmltv(schedule, timezone, "http://localhost:5001", window), iterations),
+        "render_document": measure(
+            lambda: app.render_document(app.generate_xmltv(schedule, timezone, "http://localhost:5001")), iterations),
+        # What BoundaryScheduler does when a session starts: only the channel entries are rebuilt
+        "boundary_rebuild": measure(lambda: cached_head.finish(tail(None)), iterations),
+        "cache_hit": measure(lambda: cache.get("xmltv", schedule, timezone, "http://localhost:5001", None, head, tail),
+                             iterations * 10),
+    }
+
+def bench_icons(iterations):
+    with tempfile.TemporaryDirectory() as assets_dir:
+        write_stub_assets(assets_dir, app.COUNTRY_COLORS)
+        app.asset_store.assets_dir = assets_dir
+        app.app.config['ICON_CACHE_DIR'] = None
+        codes = [None] + list(app.COUNTRY_COLORS)
+        state = {"i": 0}
+        def render_next():
+            state["i"] += 1
+            app.render_channel_icon(codes[state["i"] % len(codes)])
+        app.get_channel_icon("gb")
+        return {
+            "render_channel_icon": measure(render_next, iterations),
+            "cache_hit": measure(lambda: app.get_channel_icon("gb"), iterations * 10),
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description="In-process rendering benchmarks")
+    parser.add_argument('--iterations', type=int, default=200, help='Samples per benchmark (default: 200)')
+    parser.add_argument('--timezone', type=str, default='Europe/London', help='Output timezone (default: Europe/London)')
+    parser.add_argument('--output', type=str, default='bench_render.json', help='Where to save the JSON results')
+    args = parser.parse_args()
+
+    timezone = app._parse_timezone(args.timezone)
+    results = {name: bench_xmltv(races, args.iterations, timezone) for name, races in fixture_sets().items()}
+    results["channel_icon"] = bench_icons(args.iterations)
+    for name, stats in results.items():
+        print(name)
+        for case, value in stats.items():
+            print(f"  {case}: {value}")
+    write_results(args.output, "render", results)
+
+if __name__ == '__main__':
+    sys.exit(main())
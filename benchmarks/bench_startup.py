@@ -0,0 +1,134 @@
+"""Cold-start benchmark: time to the first /epg.xml response and idle memory of a fresh server.
+
+Starts `python -m app` as a subprocess (the way the container does) with a schedule snapshot
+made from the recorded fixture, so no upstream is needed, and polls until /epg.xml answers.
+Reports the time from spawn to the first response, to the first /channel_icon.png response
+after it, and the resident memory of the server's process tree once both have been served.
+With --max-first-response-ms the script exits non-zero when the median first response is
+slower, which the Docker build uses as a startup budget.
+
+Usage: python benchmarks/bench_startup.py [--runs 5] [--workers 0] [--prerendered-icons icons]
+                                          [--max-first-response-ms 300] [--output bench_startup.json]
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+from common import ROOT, fixture_sets, percentile, write_results, write_stub_assets
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def write_snapshot(path):
+    """Writes a fresh schedule snapshot (as ScheduleStore.save_snapshot would) so the server
+    starts with a schedule and doesn't refetch it."""
+    seasons = {}
+    for race in fixture_sets()["multi_season"]:
+        seasons.setdefault(race["season"], []).append(race)
+    with open(path, "w") as f:
+        json.dump({"format": 2, "fetched_at": time.time(), "validators": {}, "seasons": seasons}, f)
+
+def tree_rss_mb(pid):
+    """Resident memory of pid and its descendants in MiB, from /proc (None where unavailable)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            rss_kb = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+        children = []
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                children += [int(child) for child in f.read().split()]
+    except (OSError, StopIteration):
+        return None
+    return rss_kb / 1024 + sum(tree_rss_mb(child) or 0 for child in children)
+
+def _wait_for(url, process, deadline):
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with status {process.returncode}")
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                response.read()
+                return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.005)
+    raise RuntimeError(f"No response from {url}")
+
+def run_once(workdir, workers, prerendered_icons, timeout):
+    port = _free_port()
+    command = [sys.executable, "-m", "app", "--host", "127.0.0.1", "--port", str(port),
+               "--snapshot", os.path.join(workdir, "schedule_snapshot.json"),
+               "--assets-dir", os.path.join(workdir, "assets"), "--cache-dir", os.path.join(workdir, "cache"),
+               "--workers", str(workers), "--log-level", "WARNING"]
+    if prerendered_icons:
+        command += ["--prerendered-icons", prerendered_icons]
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        base = f"http://127.0.0.1:{port}"
+        _wait_for(f"{base}/epg.xml", process, time.time() + timeout)
+        first_response = time.perf_counter() - start
+        icon_start = time.perf_counter()
+        _wait_for(f"{base}/channel_icon.png?country_code=gb", process, time.time() + timeout)
+        first_icon = time.perf_counter() - icon_start
+        return {
+            "first_response_ms": round(first_response * 1000, 1),
+            "first_icon_ms": round(first_icon * 1000, 1),
+            "rss_mb": tree_rss_mb(process.pid),
+        }
+    finally:
+        process.terminate()
+        process.wait()
+
+def summarize(samples):
+    return {"p50": round(percentile(samples, 50), 1), "max": round(max(samples), 1)} if samples else None
+
+def main():
+    parser = argparse.ArgumentParser(description="Server cold-start time and idle memory")
+    parser.add_argument('--runs', type=int, default=5, help='Server starts to measure (default: 5)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Passed to app.py; 0 runs the Flask development server (default: 0)')
+    parser.add_argument('--prerendered-icons', type=str, default=None,
+                        help='Serve icons made with app.py --render-icons instead of rendering them from stub assets')
+    parser.add_argument('--max-first-response-ms', type=float, default=None,
+                        help='Exit with status 1 if the median time to the first response exceeds this')
+    parser.add_argument('--timeout', type=float, default=30, help='Seconds to wait for each response (default: 30)')
+    parser.add_argument('--output', type=str, default='bench_startup.json', help='Where to save the JSON results')
+    args = parser.parse_args()
+
+    runs = []
+    with tempfile.TemporaryDirectory() as workdir:
+        write_snapshot(os.path.join(workdir, "schedule_snapshot.json"))
+        if not args.prerendered_icons:
+            write_stub_assets(os.path.join(workdir, "assets"), ["gb"])
+        for i in range(args.runs):
+            shutil.rmtree(os.path.join(workdir, "cache"), ignore_errors=True) # Render icons afresh, like a new container
+            runs.append(run_once(workdir, args.workers, args.prerendered_icons, args.timeout))
+            print(f"  run {i + 1}: {runs[-1]}")
+
+    results = {
+        "workers": args.workers,
+        "prerendered_icons": bool(args.prerendered_icons),
+        "first_response_ms": summarize([run["first_response_ms"] for run in runs]),
+        "first_icon_ms": summarize([run["first_icon_ms"] for run in runs]),
+        "rss_mb": summarize([run["rss_mb"] for run in runs if run["rss_mb"] is not None]),
+        "runs": runs,
+    }
+    print(json.dumps({key: value for key, value in results.items() if key != "runs"}))
+    write_results(args.output, "startup", results)
+    budget = args.max_first_response_ms
+    if budget is not None and results["first_response_ms"]["p50"] > budget:
+        print(f"Median first response {results['first_response_ms']['p50']} ms exceeds the {budget:g} ms budget")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
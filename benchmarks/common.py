@@ -0,0 +1,98 @@
+"""Shared helpers for the benchmark and load-test scripts: fixtures, stub assets and result files."""
+import copy
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT) # Make `import app` work when run as python benchmarks/<script>.py
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# Sessions carrying their own date/time in a Jolpica race entry
+SESSION_KEYS = ("FirstPractice", "SecondPractice", "ThirdPractice", "Qualifying", "SprintQualifying", "Sprint")
+
+def load_fixture(name="2025.json"):
+    """Returns the races from a recorded Jolpica response in benchmarks/fixtures."""
+    with open(os.path.join(FIXTURES_DIR, name), encoding="utf-8") as f:
+        return json.load(f)["MRData"]["RaceTable"]["Races"]
+
+def _shift(entry, days):
+    start = datetime.strptime(f"{entry['date']}T{entry.get('time', '00:00:00Z')}", "%Y-%m-%dT%H:%M:%SZ")
+    entry["date"] = (start + timedelta(days=days)).strftime("%Y-%m-%d")
+
+def shift_season(races, years):
+    """Copies a season moved by whole years (in 52-week steps, so weekends stay weekends)."""
+    shifted = copy.deepcopy(races)
+    for race in shifted:
+        race["season"] = str(int(race["season"]) + years)
+        for entry in [race] + [race[key] for key in SESSION_KEYS if key in race]:
+            _shift(entry, years * 364)
+    return shifted
+
+def fixture_sets():
+    """The calendars every benchmark runs against, moved to the current year so they have
+    upcoming sessions: one season, two consecutive seasons, and a synthetic 10x calendar."""
+    base = load_fixture()
+    offset = datetime.now().year - int(base[0]["season"])
+    season = shift_season(base, offset)
+    return {
+        "single_season": season,
+        "multi_season": season + shift_season(season, 1),
+        "synthetic_10x": [race for i in range(10) for race in shift_season(season, i)],
+    }
+
+def stub_png(size, color):
+    """A solid PNG standing in for the F1 logo or a flag, so icon renders need no network."""
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new("RGBA", size, color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def write_stub_assets(assets_dir, country_codes):
+    """Fills an AssetStore directory with stub logo and flag images."""
+    os.makedirs(os.path.join(assets_dir, "flags"), exist_ok=True)
+    with open(os.path.join(assets_dir, "f1_logo.png"), "wb") as f:
+        f.write(stub_png((240, 60), (225, 6, 0, 255)))
+    for country_code in country_codes:
+        with open(os.path.join(assets_dir, "flags", f"{country_code}.png"), "wb") as f:
+            f.write(stub_png((160, 107), (0, 36, 125, 255)))
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MiB (ru_maxrss is KiB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def _git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def write_results(path, benchmark, results):
+    """Saves results as JSON together with enough context to compare runs across versions."""
+    report = {
+        "benchmark": benchmark,
+        "revision": _git_revision(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {path}")
+    return report
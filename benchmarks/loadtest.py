@@ -0,0 +1,149 @@
+"""Load test for /epg.xml and /channel_icon.png under concurrent polling.
+
+Starts local stubs standing in for Jolpica, formula1.com and flagcdn.com, points the app at
+them, serves it in-process with werkzeug's threaded server and drives it from --clients
+concurrent keep-alive clients for --duration seconds. Reports p50/p99 latency and requests/sec
+per endpoint plus peak RSS (of this process, so stubs and clients are included).
+
+Usage: python benchmarks/loadtest.py [--clients 50] [--duration 20] [--output loadtest.json]
+       python benchmarks/loadtest.py --target http://127.0.0.1:5001  # an already running server
+"""
+import argparse
+import json
+import logging
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from werkzeug.serving import make_server
+
+from common import fixture_sets, percentile, stub_png, write_results
+
+import app
+
+def start_upstream_stub():
+    """Serves recorded fixtures for /ergast/f1/<year>.json and stub PNGs for the logo and flags."""
+    seasons = {}
+    for race in fixture_sets()["multi_season"]:
+        seasons.setdefault(race["season"], []).append(race)
+    logo = stub_png((240, 60), (225, 6, 0, 255))
+    flag = stub_png((160, 107), (0, 36, 125, 255))
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            match = re.fullmatch(r"/ergast/f1/(\d+)\.json", self.path)
+            if match:
+                races = seasons.get(match.group(1), [])
+                body = json.dumps({"MRData": {"RaceTable": {"season": match.group(1), "Races": races}}}).encode()
+                content_type = "application/json"
+            elif self.path == "/logo.png" or self.path.startswith("/flags/"):
+                body = logo if self.path == "/logo.png" else flag
+                content_type = "image/png"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+def start_app(workdir):
+    """Points the app's upstream URLs at the stubs and serves it on an ephemeral port."""
+    upstream = start_upstream_stub()
+    app.JOLPICA_URL = upstream + "/ergast/f1/{year}.json"
+    app.F1_LOGO_URL = upstream + "/logo.png"
+    app.FLAG_BASE_URL = upstream + "/flags/"
+    app.create_app(timezone_name="Europe/London", snapshot=f"{workdir}/schedule_snapshot.json",
+                   assets_dir=f"{workdir}/assets", cache_dir=f"{workdir}/cache")
+    deadline = time.time() + 30
+    while app.schedule_store.schedule is None and time.time() < deadline:
+        time.sleep(0.05)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR) # No access log line per request
+    server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+def run_client(target, deadline, icon_ratio, samples, errors):
+    session = requests.Session()
+    etag = None
+    while time.time() < deadline:
+        if random.random() < icon_ratio:
+            endpoint = "channel_icon"
+            url = f"{target}/channel_icon.png?country_code={random.choice(list(app.COUNTRY_COLORS))}"
+            headers = {}
+        else:
+            endpoint = "epg"
+            url = f"{target}/epg.xml"
+            headers = {"Accept-Encoding": "gzip"}
+            # Half the EPG polls revalidate like Kodi/Plex/Jellyfin clients holding a copy
+            if etag and random.random() < 0.5:
+                endpoint = "epg_conditional"
+                headers["If-None-Match"] = etag
+        start = time.perf_counter()
+        try:
+            response = session.get(url, headers=headers, timeout=30)
+            response.content
+        except requests.exceptions.RequestException:
+            errors[endpoint] = errors.get(endpoint, 0) + 1
+            continue
+        samples.setdefault(endpoint, []).append((time.perf_counter() - start) * 1000)
+        if response.status_code >= 400:
+            errors[endpoint] = errors.get(endpoint, 0) + 1
+        elif endpoint == "epg":
+            etag = response.headers.get("ETag")
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent polling load test")
+    parser.add_argument('--clients', type=int, default=50, help='Concurrent clients (default: 50)')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds to run (default: 20)')
+    parser.add_argument('--icon-ratio', type=float, default=0.2,
+                        help='Fraction of requests for /channel_icon.png (default: 0.2)')
+    parser.add_argument('--target', type=str, default=None,
+                        help='Base URL of an already running server to test instead of the in-process one')
+    parser.add_argument('--output', type=str, default='loadtest.json', help='Where to save the JSON results')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        target = args.target or start_app(workdir)
+        deadline = time.time() + args.duration
+        per_client = [({}, {}) for _ in range(args.clients)]
+        threads = [threading.Thread(target=run_client, args=(target, deadline, args.icon_ratio, samples, errors))
+                   for samples, errors in per_client]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+
+    results = {"clients": args.clients, "duration_s": round(elapsed, 2), "endpoints": {}}
+    for endpoint in ("epg", "epg_conditional", "channel_icon"):
+        samples = [s for client_samples, _ in per_client for s in client_samples.get(endpoint, [])]
+        results["endpoints"][endpoint] = {
+            "requests": len(samples),
+            "errors": sum(client_errors.get(endpoint, 0) for _, client_errors in per_client),
+            "requests_per_s": round(len(samples) / elapsed, 1),
+            "p50_ms": round(percentile(samples, 50), 3),
+            "p99_ms": round(percentile(samples, 99), 3),
+        }
+    results["requests_per_s"] = round(sum(e["requests_per_s"] for e in results["endpoints"].values()), 1)
+    print(json.dumps(results, indent=2))
+    write_results(args.output, "loadtest", results)
+
+if __name__ == '__main__':
+    sys.exit(main())